@@ -0,0 +1,105 @@
+"""Dynamic micro-batching for the local diffusers pipeline.
+
+Pending requests with identical generation parameters are collected for a
+short window and run through the pipeline as one batched call; each
+caller then receives its own image.
+"""
+import asyncio
+import os
+import time
+
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 4))
+BATCH_MAX_WAIT_MS = int(os.getenv('BATCH_MAX_WAIT_MS', 100))
+
+
+class BatchScheduler:
+    """Group compatible requests and run them with run_batch(params, prompts).
+
+    run_batch is a blocking callable returning one result per prompt; it is
+    executed in a worker thread, up to max_concurrent_batches at a time.
+    """
+
+    def __init__(self, run_batch, max_batch_size: int = BATCH_MAX_SIZE,
+                 max_wait_ms: int = BATCH_MAX_WAIT_MS, max_concurrent_batches: int = 1):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self._pending = {}
+        self._ready = None
+        self._queued_keys = set()
+        self._workers = []
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.busy_seconds = 0.0
+
+    async def submit(self, params: dict, prompt: str):
+        """Queue prompt with params and wait for its result"""
+        loop = asyncio.get_running_loop()
+        if not self._workers or all(worker.done() for worker in self._workers):
+            self._ready = asyncio.Queue()
+            self._queued_keys.clear()
+            self._workers = [asyncio.ensure_future(self._run()) for _ in range(self.max_concurrent_batches)]
+
+        key = tuple(sorted(params.items()))
+        future = loop.create_future()
+        group = self._pending.setdefault(key, [])
+        group.append((prompt, future))
+        if len(group) >= self.max_batch_size:
+            self._mark_ready(key)
+        elif len(group) == 1:
+            loop.call_later(self.max_wait, self._mark_ready, key)
+        return await future
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": int(self.max_wait * 1000),
+            "max_concurrent_batches": self.max_concurrent_batches,
+            "queued": sum(len(group) for group in self._pending.values()),
+            "batches": self.batches,
+            "items": self.items,
+            "largest_batch": self.largest_batch,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "busy_seconds": round(self.busy_seconds, 2)
+        }
+
+    def _mark_ready(self, key):
+        if self._pending.get(key) and key not in self._queued_keys:
+            self._queued_keys.add(key)
+            self._ready.put_nowait(key)
+
+    async def _run(self):
+        while True:
+            key = await self._ready.get()
+            self._queued_keys.discard(key)
+            group = self._pending.pop(key, [])
+            batch = [(prompt, future) for prompt, future in group if not future.done()]
+            if len(batch) > self.max_batch_size:
+                # Leftovers have already waited their window; run them next
+                self._pending[key] = batch[self.max_batch_size:]
+                batch = batch[:self.max_batch_size]
+                self._mark_ready(key)
+            if not batch:
+                continue
+
+            prompts = [prompt for prompt, _ in batch]
+            print(f"📦 Running batch of {len(prompts)} ({dict(key)})")
+            start = time.perf_counter()
+            try:
+                results = await asyncio.to_thread(self.run_batch, dict(key), prompts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.busy_seconds += time.perf_counter() - start
+
+            self.batches += 1
+            self.items += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
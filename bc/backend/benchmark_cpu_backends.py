@@ -0,0 +1,115 @@
+"""Compare CPU inference backends against the fp32 baseline.
+
+Each backend runs in its own subprocess so peak RSS is measured cleanly.
+Reports load time, per-generation latency, peak RSS and output similarity
+(PSNR / mean absolute pixel difference) against the fp32 image.
+
+Usage:
+    python benchmark_cpu_backends.py --backends fp32 int8 bf16 channels_last int8,channels_last
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_PROMPT = "a red fox sitting in the snow, photograph"
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_worker(args):
+    """Load one backend, generate args.runs images and print JSON results"""
+    import torch
+    from sd_pipeline import load_pipeline, run_pipeline_batch
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    start = time.perf_counter()
+    pipe = load_pipeline("cpu", torch.float32, cpu_backend=args.worker)
+    load_seconds = time.perf_counter() - start
+
+    latencies = []
+    image = None
+    for _ in range(args.warmup + args.runs):
+        start = time.perf_counter()
+        image = run_pipeline_batch(pipe, [args.prompt], args.size, args.size, 7.5, args.steps, seed=42)[0]
+        latencies.append(time.perf_counter() - start)
+    image.save(args.output)
+
+    timed = latencies[args.warmup:]
+    print(json.dumps({
+        "load_seconds": round(load_seconds, 2),
+        "mean_seconds": round(sum(timed) / len(timed), 2),
+        "min_seconds": round(min(timed), 2),
+        "peak_rss_mb": peak_rss_mb()
+    }))
+
+
+def similarity(baseline_path, candidate_path):
+    import numpy as np
+    from PIL import Image
+
+    baseline = np.asarray(Image.open(baseline_path).convert("RGB"), dtype=np.float64)
+    candidate = np.asarray(Image.open(candidate_path).convert("RGB"), dtype=np.float64)
+    mse = np.mean((baseline - candidate) ** 2)
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+    return {"psnr_db": round(psnr, 2), "mean_abs_diff": round(float(np.mean(np.abs(baseline - candidate))), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=["fp32", "int8", "bf16", "channels_last"])
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    backends = args.backends if "fp32" in args.backends else ["fp32"] + args.backends
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in backends:
+            output = os.path.join(tmp, f"{backend.replace(',', '_')}.png")
+            print(f"⏱️ Benchmarking {backend}...")
+            cmd = [sys.executable, os.path.abspath(__file__), "--worker", backend, "--output", output,
+                   "--prompt", args.prompt, "--steps", str(args.steps), "--size", str(args.size),
+                   "--runs", str(args.runs), "--warmup", str(args.warmup), "--threads", str(args.threads)]
+            proc = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            if proc.returncode != 0:
+                print(f"❌ {backend} failed:\n{proc.stderr[-2000:]}")
+                continue
+            results[backend] = json.loads(proc.stdout.strip().splitlines()[-1])
+            results[backend]["image"] = output
+
+        baseline = results.get("fp32")
+        print(f"\n{'backend':<24}{'load s':>8}{'mean s':>8}{'min s':>8}{'RSS MB':>9}{'PSNR dB':>9}{'MAD':>7}{'speedup':>9}")
+        for backend, result in results.items():
+            score = similarity(baseline["image"], result["image"]) if baseline else {}
+            speedup = baseline["mean_seconds"] / result["mean_seconds"] if baseline else float("nan")
+            print(f"{backend:<24}{result['load_seconds']:>8}{result['mean_seconds']:>8}{result['min_seconds']:>8}"
+                  f"{str(result['peak_rss_mb']):>9}{str(score.get('psnr_db')):>9}{str(score.get('mean_abs_diff')):>7}"
+                  f"{speedup:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
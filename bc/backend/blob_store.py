@@ -0,0 +1,166 @@
+"""Content-addressed, sharded storage for generated images.
+
+Each image is stored once under the SHA-256 of its bytes, e.g.
+``3fa2...c9.png``, so identical outputs share one file and names never
+collide. Files live in nested shard directories taken from the leading hex
+digits of the hash (``generated_images/3f/a2/3fa2...c9.png`` with the
+default depth of 2), which keeps every directory small past millions of
+images. The blob name is what rows and history records store as
+``filename``; older timestamp names still resolve to the flat directory.
+
+Rows reference blobs by name. For SQLite galleries ``init_blob_refs`` keeps
+a per-blob reference count in step with inserts and deletes via triggers,
+and a blob is only removed once nothing references it. A blob that was
+written or reused within BLOB_GC_GRACE_SECONDS is not removed yet, because
+a row for it may still be waiting to be committed.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+
+BLOB_SHARD_DEPTH = int(os.getenv('BLOB_SHARD_DEPTH', 2))
+BLOB_GC_GRACE_SECONDS = int(os.getenv('BLOB_GC_GRACE_SECONDS', 60))
+SHARD_WIDTH = 2
+
+BLOB_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+SHARD_PATTERN = re.compile(r"^[0-9a-f]{%d}$" % SHARD_WIDTH)
+
+REFS_SCHEMA = '''
+    BEGIN IMMEDIATE;
+
+    CREATE TABLE blob_refs (
+        name TEXT PRIMARY KEY,
+        refs INTEGER NOT NULL
+    ) WITHOUT ROWID;
+
+    INSERT INTO blob_refs (name, refs)
+    SELECT {column}, COUNT(*) FROM {table} GROUP BY {column};
+
+    CREATE TRIGGER blob_refs_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO blob_refs (name, refs) VALUES (NEW.{column}, 1)
+        ON CONFLICT (name) DO UPDATE SET refs = refs + 1;
+    END;
+
+    CREATE TRIGGER blob_refs_delete AFTER DELETE ON {table} BEGIN
+        UPDATE blob_refs SET refs = refs - 1 WHERE name = OLD.{column};
+        DELETE FROM blob_refs WHERE name = OLD.{column} AND refs <= 0;
+    END;
+
+    COMMIT;
+'''
+
+
+def blob_name(data: bytes, extension: str = "png") -> str:
+    return f"{hashlib.sha256(data).hexdigest()}.{extension}"
+
+
+def shard_dirs(name: str):
+    """Shard directory names for a blob name ([] for legacy flat names)"""
+    if not BLOB_NAME_PATTERN.match(name):
+        return []
+    return [name[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(BLOB_SHARD_DEPTH)]
+
+
+def blob_path(root: str, name: str) -> str:
+    return os.path.join(root, *shard_dirs(name), name)
+
+
+def iter_blob_names(root: str):
+    """Yield the name of every stored image: legacy flat files, then sharded blobs"""
+    def walk(directory, depth):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    # Files above the shard depth are legacy images (or blobs at depth 0)
+                    if not entry.name.endswith(".tmp"):
+                        yield entry.name
+                elif depth > 0 and entry.is_dir() and SHARD_PATTERN.match(entry.name):
+                    yield from walk(entry.path, depth - 1)
+
+    yield from walk(root, BLOB_SHARD_DEPTH)
+
+
+def init_blob_refs(conn, table: str = "images", column: str = "filename"):
+    """Create the reference-count table and triggers once, seeding them from table"""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'blob_refs'").fetchone()
+    if not exists:
+        conn.executescript(REFS_SCHEMA.format(table=table, column=column))
+        print(f"🔗 Blob reference counts initialized for {table}")
+
+
+def blob_refcount(conn, name: str) -> int:
+    row = conn.execute('SELECT refs FROM blob_refs WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+class BlobStore:
+    """Deduplicating file store rooted at root"""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        # Callers hold this while pairing put()/remove() with their own reference
+        # bookkeeping, so a delete cannot unlink a blob a concurrent put just reused
+        self.reference_lock = threading.RLock()
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.dedupe_hits = 0
+        self.bytes_deduplicated = 0
+        self.removed = 0
+
+    def path(self, name: str) -> str:
+        return blob_path(self.root, name)
+
+    def put(self, data: bytes, extension: str = "png") -> str:
+        """Store data unless an identical blob exists; returns its name"""
+        name = blob_name(data, extension)
+        path = self.path(name)
+        try:
+            # Reusing a blob restarts its grace period, see remove()
+            os.utime(path)
+            with self._lock:
+                self.dedupe_hits += 1
+                self.bytes_deduplicated += len(data)
+            return name
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see a partial file; racing writers
+        # of the same blob write identical bytes
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.writes += 1
+        return name
+
+    def remove(self, name: str, min_age: float = 0) -> bool:
+        """Unlink a blob the caller knows is unreferenced.
+
+        Returns False, leaving the file, when it was written or reused less
+        than min_age seconds ago; a missing file counts as removed.
+        """
+        path = self.path(name)
+        try:
+            if min_age and time.time() - os.stat(path).st_mtime < min_age:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return True
+        with self._lock:
+            self.removed += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "shard_depth": BLOB_SHARD_DEPTH,
+                "writes": self.writes,
+                "dedupe_hits": self.dedupe_hits,
+                "bytes_deduplicated": self.bytes_deduplicated,
+                "removed": self.removed
+            }
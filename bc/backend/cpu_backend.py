@@ -0,0 +1,67 @@
+"""Optimized CPU inference backends for the local pipeline.
+
+CPU_BACKEND is a comma-separated list of optimizations applied after the
+pipeline is loaded on CPU:
+
+  fp32           no changes (default)
+  int8           dynamic int8 quantization of UNet and text encoder Linear layers
+  bf16           bfloat16 weights, only when the CPU has native bf16 support
+  channels_last  channels-last memory format for the UNet and VAE convolutions
+  compile        torch.compile the UNet
+
+int8 needs float32 weights, so it is skipped when bf16 is also active.
+"""
+import os
+import torch
+
+CPU_BACKEND = os.getenv('CPU_BACKEND', 'fp32')
+OPTIMIZATIONS = ("fp32", "int8", "bf16", "channels_last", "compile")
+
+
+def parse_backend(spec: str):
+    """Split a backend spec like 'int8,channels_last' into validated names"""
+    names = [name.strip().lower() for name in spec.split(",") if name.strip()]
+    unknown = [name for name in names if name not in OPTIMIZATIONS]
+    if unknown:
+        raise ValueError(f"Unknown CPU backend option(s): {', '.join(unknown)}")
+    return [name for name in names if name != "fp32"]
+
+
+def cpu_supports_bf16() -> bool:
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def optimize_pipeline(pipe, backend: str = CPU_BACKEND):
+    """Apply the optimizations named in backend to pipe; returns those applied"""
+    options = parse_backend(backend)
+    applied = []
+
+    if "bf16" in options:
+        if cpu_supports_bf16():
+            pipe.to(torch.bfloat16)
+            applied.append("bf16")
+        else:
+            print("⚠️ CPU has no native bfloat16 support, keeping float32")
+
+    if "int8" in options:
+        if pipe.unet.dtype == torch.float32:
+            for module in (pipe.unet, pipe.text_encoder):
+                torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            applied.append("int8")
+        else:
+            print("⚠️ int8 dynamic quantization needs float32 weights, skipping")
+
+    if "channels_last" in options:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+        applied.append("channels_last")
+
+    if "compile" in options:
+        pipe.unet = torch.compile(pipe.unet)
+        applied.append("compile")
+
+    print(f"⚙️ CPU backend: {', '.join(applied) or 'fp32'}")
+    return applied
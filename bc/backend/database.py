@@ -3,10 +3,17 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime, timedelta
 import os
+import asyncio
 
 DATABASE_URL = "sqlite:///./chat_history.db"
 Base = declarative_base()
 
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 class ChatHistory(Base):
     __tablename__ = "chat_history"
 
@@ -16,16 +23,23 @@ class ChatHistory(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
 
     @classmethod
-    async def cleanup_old_records(cls, session):
+    async def cleanup_old_records(cls, session, chunk_size: int = 500):
+        """Delete records older than 30 days in chunks, unlinking their images off the event loop"""
         threshold = datetime.utcnow() - timedelta(days=30)
-        old_records = session.query(cls).filter(cls.created_at < threshold).all()
-        
-        for record in old_records:
-            if os.path.exists(record.image_path):
-                os.remove(record.image_path)
-            session.delete(record)
-        
-        session.commit()
+        while True:
+            # Only the columns needed, not full ORM objects
+            rows = session.query(cls.id, cls.image_path)\
+                          .filter(cls.created_at < threshold)\
+                          .order_by(cls.created_at)\
+                          .limit(chunk_size)\
+                          .all()
+            if not rows:
+                break
+            session.query(cls).filter(cls.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+            session.commit()
+            await asyncio.gather(*(asyncio.to_thread(remove_file, row.image_path) for row in rows))
+            if len(rows) < chunk_size:
+                break
 
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
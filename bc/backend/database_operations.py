@@ -1,7 +1,9 @@
+from sqlalchemy import text, tuple_
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 import logging
 from database_setup import ChatHistory
+from prompt_search import build_match_query
 
 logger = logging.getLogger(__name__)
 
@@ -21,29 +23,46 @@ async def create_chat_record(db: Session, prompt: str, image_path: str):
         db.rollback()
         raise
 
-async def get_chat_history(db: Session, skip: int = 0, limit: int = 10):
+async def get_chat_history(db: Session, limit: int = 10, before: tuple = None):
+    """Newest-first page of history; pass (created_at, id) of the last record as before for the next page"""
     try:
-        return db.query(ChatHistory)\
-                 .order_by(ChatHistory.created_at.desc())\
-                 .offset(skip)\
-                 .limit(limit)\
-                 .all()
+        query = db.query(ChatHistory)
+        if before is not None:
+            # Keyset pagination instead of OFFSET, so later pages cost the same as the first
+            query = query.filter(tuple_(ChatHistory.created_at, ChatHistory.id) < tuple_(*before))
+        return query.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc())\
+                    .limit(limit)\
+                    .all()
     except Exception as e:
         logger.error(f"Error fetching chat history: {e}")
         raise
 
+async def search_chat_history(db: Session, query: str, limit: int = 10, offset: int = 0):
+    """History records whose prompt matches query, best matches first"""
+    match_query = build_match_query(query)
+    if match_query is None:
+        return []
+    try:
+        ids = db.execute(
+            text("SELECT rowid FROM chat_history_fts WHERE chat_history_fts MATCH :q ORDER BY rank LIMIT :limit OFFSET :offset"),
+            {"q": match_query, "limit": limit, "offset": offset}
+        ).scalars().all()
+        records = {record.id: record for record in db.query(ChatHistory).filter(ChatHistory.id.in_(ids)).all()}
+        return [records[record_id] for record_id in ids if record_id in records]
+    except Exception as e:
+        logger.error(f"Error searching chat history: {e}")
+        raise
+
 async def cleanup_old_records(db: Session, days: int = 30):
     try:
         threshold = datetime.utcnow() - timedelta(days=days)
-        old_records = db.query(ChatHistory)\
-                       .filter(ChatHistory.created_at < threshold)\
-                       .all()
-        
-        for record in old_records:
-            db.delete(record)
+        # One set-based DELETE instead of loading and deleting each record
+        deleted = db.query(ChatHistory)\
+                    .filter(ChatHistory.created_at < threshold)\
+                    .delete(synchronize_session=False)
         
         db.commit()
-        logger.info(f"Cleaned up {len(old_records)} old records")
+        logger.info(f"Cleaned up {deleted} old records")
     except Exception as e:
         logger.error(f"Error cleaning up old records: {e}")
         db.rollback()
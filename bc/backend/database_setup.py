@@ -1,9 +1,10 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 import logging
 import os
+from prompt_search import init_prompt_search
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,12 +22,23 @@ class ChatHistory(Base):
     image_path = Column(String(255), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (Index("idx_chat_history_created_at", "created_at", "id"),)
+
 # Create database engine and session
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # create_all skips indexes on tables that already exist
+    for index in ChatHistory.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    # Full-text prompt search (see prompt_search.py)
+    conn = engine.raw_connection()
+    try:
+        init_prompt_search(conn.driver_connection, "chat_history")
+    finally:
+        conn.close()
     logger.info("Database initialized")
 
 def get_db():
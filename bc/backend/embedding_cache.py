@@ -0,0 +1,92 @@
+"""LRU cache of CLIP text-encoder embeddings for the local pipeline.
+
+Templated prompts and the empty negative prompt are encoded once and then
+passed to the pipeline as precomputed ``prompt_embeds``.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+EMBEDDING_CACHE_ENABLED = os.getenv('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true'
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
+class PromptEmbeddingCache:
+    """Memory-bounded LRU of prompt -> embedding tensor"""
+
+    def __init__(self, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Repeats of a prompt within one batch, encoded (or looked up) once
+        self.deduplicated = 0
+        self.evictions = 0
+        self.encode_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def get_embeddings(self, pipe, prompts):
+        """Return stacked embeddings for prompts, encoding only the misses"""
+        import torch
+
+        with self._lock:
+            found = {prompt: self._entries[prompt] for prompt in set(prompts) if prompt in self._entries}
+            for prompt in found:
+                self._entries.move_to_end(prompt)
+            missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in found]
+            hit_count = len(found)
+
+        if missing:
+            start = time.perf_counter()
+            with torch.no_grad():
+                embeds, _ = pipe.encode_prompt(missing, pipe._execution_device, 1, False)
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.encode_seconds += elapsed
+                for prompt, embedding in zip(missing, embeds):
+                    # Clone so a cached row does not pin the whole batch tensor
+                    embedding = embedding.clone()
+                    found[prompt] = embedding
+                    self._put(prompt, embedding)
+
+        with self._lock:
+            self.hits += hit_count
+            self.misses += len(missing)
+            self.deduplicated += len(prompts) - hit_count - len(missing)
+            if self.misses:
+                # Every hit saves roughly one average encode
+                self.saved_seconds += hit_count * self.encode_seconds / self.misses
+
+        return torch.stack([found[prompt] for prompt in prompts])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "deduplicated": self.deduplicated,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "encode_seconds": round(self.encode_seconds, 3),
+                "saved_seconds": round(self.saved_seconds, 3)
+            }
+
+    def _put(self, prompt, embedding):
+        size = embedding.element_size() * embedding.nelement()
+        if size > self.max_bytes:
+            return
+        if prompt in self._entries:
+            return
+        self._entries[prompt] = embedding
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.element_size() * evicted.nelement()
+            self.evictions += 1
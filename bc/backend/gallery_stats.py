@@ -0,0 +1,83 @@
+"""Incrementally maintained gallery statistics.
+
+Triggers on ``images`` keep a single-row total (count and bytes) and one
+row per day in step with every insert and delete, including retention
+deletes. Reading the stats is a primary-key lookup plus a scan of at most
+one row per retained day, independent of the number of images.
+"""
+
+SCHEMA = '''
+    BEGIN IMMEDIATE;
+
+    CREATE TABLE gallery_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_images INTEGER NOT NULL,
+        total_bytes INTEGER NOT NULL
+    );
+
+    CREATE TABLE gallery_daily_stats (
+        day TEXT PRIMARY KEY,
+        images INTEGER NOT NULL,
+        bytes INTEGER NOT NULL
+    );
+
+    -- One scan to seed the aggregates; triggers keep them current afterwards
+    INSERT INTO gallery_stats (id, total_images, total_bytes)
+    SELECT 1, COUNT(*), COALESCE(SUM(file_size), 0) FROM images;
+
+    INSERT INTO gallery_daily_stats (day, images, bytes)
+    SELECT date(created_at), COUNT(*), COALESCE(SUM(file_size), 0) FROM images GROUP BY date(created_at);
+
+    CREATE TRIGGER gallery_stats_insert AFTER INSERT ON images BEGIN
+        UPDATE gallery_stats
+        SET total_images = total_images + 1, total_bytes = total_bytes + COALESCE(NEW.file_size, 0)
+        WHERE id = 1;
+        INSERT INTO gallery_daily_stats (day, images, bytes)
+        VALUES (date(NEW.created_at), 1, COALESCE(NEW.file_size, 0))
+        ON CONFLICT (day) DO UPDATE SET images = images + 1, bytes = bytes + excluded.bytes;
+    END;
+
+    CREATE TRIGGER gallery_stats_delete AFTER DELETE ON images BEGIN
+        UPDATE gallery_stats
+        SET total_images = total_images - 1, total_bytes = total_bytes - COALESCE(OLD.file_size, 0)
+        WHERE id = 1;
+        UPDATE gallery_daily_stats
+        SET images = images - 1, bytes = bytes - COALESCE(OLD.file_size, 0)
+        WHERE day = date(OLD.created_at);
+        DELETE FROM gallery_daily_stats WHERE day = date(OLD.created_at) AND images <= 0;
+    END;
+
+    COMMIT;
+'''
+
+
+def init_gallery_stats(conn):
+    """Create the aggregate tables and triggers once, seeding them from images"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'gallery_stats'"
+    ).fetchone()
+    if not exists:
+        conn.executescript(SCHEMA)
+        print("📊 Gallery statistics initialized")
+
+
+def read_total_images(conn) -> int:
+    row = conn.execute('SELECT total_images FROM gallery_stats WHERE id = 1').fetchone()
+    return row[0] if row else 0
+
+
+def read_gallery_stats(conn, recent_days: int = 7):
+    """Totals and the number of images created in the last recent_days days"""
+    row = conn.execute('SELECT total_images, total_bytes FROM gallery_stats WHERE id = 1').fetchone()
+    total_images, total_bytes = row if row else (0, 0)
+    recent_images = conn.execute(
+        "SELECT COALESCE(SUM(images), 0) FROM gallery_daily_stats WHERE day > date('now', ?)",
+        (f"-{recent_days} days",)
+    ).fetchone()[0]
+    daily = conn.execute('SELECT day, images, bytes FROM gallery_daily_stats ORDER BY day DESC').fetchall()
+    return {
+        "total_images": total_images,
+        "total_bytes": total_bytes,
+        "recent_images": recent_images,
+        "daily": [{"day": day, "images": images, "bytes": size} for day, images, size in daily]
+    }
@@ -0,0 +1,118 @@
+"""Content-addressed cache for generated images.
+
+Maps a key built from the normalized prompt and every generation parameter
+to an image that is already stored in ``generated_images``, so repeated
+requests can be answered without calling the upstream provider again.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from blob_store import blob_path
+
+GENERATION_CACHE_MAX_BYTES = int(os.getenv('GENERATION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+GENERATION_CACHE_POLICY = os.getenv('GENERATION_CACHE_POLICY', 'lru').lower()
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase the prompt and collapse whitespace"""
+    return " ".join(prompt.lower().split())
+
+
+def make_cache_key(prompt: str, **params) -> str:
+    """Build a stable key from the normalized prompt and generation parameters"""
+    payload = {"prompt": normalize_prompt(prompt), **params}
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class GenerationCache:
+    """Byte-bounded index of cached generations with LRU or LFU eviction.
+
+    The cache never owns the image files: they belong to the gallery, so
+    eviction only forgets the entry and deletes go through
+    ``invalidate_filename``.
+    """
+
+    def __init__(self, images_dir: str, max_bytes: int = GENERATION_CACHE_MAX_BYTES,
+                 policy: str = GENERATION_CACHE_POLICY):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown cache policy: {policy}")
+        self.images_dir = images_dir
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._entries = OrderedDict()
+        self._keys_by_filename = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        """Return the cached entry for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not os.path.exists(blob_path(self.images_dir, entry["filename"])):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            entry["hits"] += 1
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry)
+
+    def put(self, key: str, filename: str, size: int, **metadata):
+        """Remember that key was rendered to filename"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {"filename": filename, "size": size, "hits": 0, **metadata}
+            # Identical images are stored once, so several keys can share a file
+            self._keys_by_filename.setdefault(filename, set()).add(key)
+            self.total_bytes += size
+            self._evict()
+
+    def invalidate_filename(self, filename: str):
+        """Drop the entries pointing at filename, if any"""
+        with self._lock:
+            for key in list(self._keys_by_filename.get(filename, ())):
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "policy": self.policy,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        keys = self._keys_by_filename.get(entry["filename"])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_filename[entry["filename"]]
+        self.total_bytes -= entry["size"]
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            if self.policy == "lfu":
+                # Ties go to the least recently used entry
+                victim = min(self._entries, key=lambda k: self._entries[k]["hits"])
+            else:
+                victim = next(iter(self._entries))
+            self._remove(victim)
+            self.evictions += 1
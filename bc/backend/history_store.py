@@ -0,0 +1,208 @@
+"""Append-only image history with an in-memory id index.
+
+The history is a JSON snapshot (the existing ``image_history.json`` list)
+plus a JSON-lines log of changes since that snapshot, next to it as
+``<snapshot>.log``. Adding or deleting a record appends one line and
+updates an in-memory dict keyed by id, so each request does a constant
+amount of history I/O. Every HISTORY_COMPACT_EVERY log entries the current
+records are written to a new snapshot and the log is reset, both by
+writing a temp file and renaming it over the old one.
+
+Several processes can share the files. Changes are serialized with an
+exclusive flock on ``<snapshot>.lock``. Each process reads the log lines
+written by the others before it acts, and reloads when another process
+has compacted. Replaying the log is idempotent, so a crash during
+compaction loses nothing.
+"""
+import json
+import os
+import threading
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process locking only
+    fcntl = None
+
+HISTORY_COMPACT_EVERY = int(os.getenv('HISTORY_COMPACT_EVERY', 1000))
+HISTORY_FSYNC = os.getenv('HISTORY_FSYNC', 'false').lower() == 'true'
+
+
+class HistoryStore:
+    """Image history records keyed by their "id" field, in insertion order"""
+
+    def __init__(self, snapshot_path: str, compact_every: int = HISTORY_COMPACT_EVERY):
+        self.snapshot_path = snapshot_path
+        self.log_path = f"{snapshot_path}.log"
+        self.compact_every = compact_every
+        self._records = {}
+        self._filename_refs = Counter()
+        self._log_offset = 0
+        self._log_id = None
+        self._log_entries = 0
+        self._thread_lock = threading.RLock()
+        self._lock_file = open(f"{snapshot_path}.lock", "a")
+        self.compactions = 0
+        with self._locked():
+            self._reload()
+
+    def __len__(self):
+        return len(self._records)
+
+    def list(self):
+        with self._locked():
+            self._catch_up()
+            return list(self._records.values())
+
+    def get(self, record_id):
+        with self._locked():
+            self._catch_up()
+            return self._records.get(record_id)
+
+    def filename_refs(self, filename):
+        """How many records point at filename (images are deduplicated by content)"""
+        with self._locked():
+            self._catch_up()
+            return self._filename_refs[filename]
+
+    def append(self, record: dict):
+        with self._locked():
+            self._catch_up()
+            self._write({"op": "add", "record": record})
+            self._add(record)
+            self._compact_if_needed()
+
+    def delete(self, record_id):
+        """Remove a record; returns it, or None if there is no such id"""
+        with self._locked():
+            self._catch_up()
+            if record_id not in self._records:
+                return None
+            self._write({"op": "delete", "id": record_id})
+            record = self._pop(record_id)
+            self._compact_if_needed()
+            return record
+
+    def compact(self):
+        """Write all records to a new snapshot and start an empty log"""
+        with self._locked():
+            self._catch_up()
+            self._replace_file(self.snapshot_path, json.dumps(list(self._records.values()), indent=2, default=str))
+            self._replace_file(self.log_path, "")
+            stat = os.stat(self.log_path)
+            self._log_id = (stat.st_dev, stat.st_ino)
+            self._log_offset = 0
+            self._log_entries = 0
+            self.compactions += 1
+
+    def stats(self):
+        return {
+            "records": len(self._records),
+            "log_entries": self._log_entries,
+            "compact_every": self.compact_every,
+            "compactions": self.compactions,
+            "cross_process_locking": fcntl is not None
+        }
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _reload(self):
+        self._records = {}
+        self._filename_refs = Counter()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                for record in json.load(f):
+                    self._add(record)
+        self._log_offset = 0
+        self._log_id = None
+        self._log_entries = 0
+        self._catch_up()
+
+    def _catch_up(self):
+        """Apply log lines appended since we last read (by any process)"""
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return
+        log_id = (stat.st_dev, stat.st_ino)
+        if self._log_id is not None and (log_id != self._log_id or stat.st_size < self._log_offset):
+            # Another process compacted: its new snapshot already has everything
+            self._reload()
+            return
+        self._log_id = log_id
+        if stat.st_size == self._log_offset:
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_offset)
+            data = f.read()
+        # A line without a newline is a write that never finished; ignore it
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print(f"⚠️ Skipping damaged history log line: {line[:80]!r}")
+                continue
+            self._apply(entry)
+        self._log_offset += len(complete)
+
+    def _apply(self, entry):
+        if entry["op"] == "add":
+            self._add(entry["record"])
+        elif entry["op"] == "delete":
+            self._pop(entry["id"])
+        self._log_entries += 1
+
+    def _add(self, record):
+        self._pop(record["id"])
+        self._records[record["id"]] = record
+        self._filename_refs[record.get("filename")] += 1
+
+    def _pop(self, record_id):
+        record = self._records.pop(record_id, None)
+        if record is not None:
+            self._filename_refs[record.get("filename")] -= 1
+            if self._filename_refs[record.get("filename")] <= 0:
+                del self._filename_refs[record.get("filename")]
+        return record
+
+    def _write(self, entry):
+        line = (json.dumps(entry, default=str) + "\n").encode()
+        with open(self.log_path, "ab") as f:
+            if f.tell() != self._log_offset:
+                # Keep an unfinished line from a crashed writer separate from ours
+                line = b"\n" + line
+            f.write(line)
+            f.flush()
+            if HISTORY_FSYNC:
+                os.fsync(f.fileno())
+            stat = os.fstat(f.fileno())
+            self._log_offset = f.tell()
+        self._log_id = (stat.st_dev, stat.st_ino)
+        self._log_entries += 1
+
+    def _compact_if_needed(self):
+        if self._log_entries >= self.compact_every:
+            self.compact()
+
+    def _replace_file(self, path, content):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
@@ -0,0 +1,177 @@
+"""Thumbnail and preview derivatives for gallery images.
+
+Derivatives are written once (at generation time, on first request, or by
+the startup backfill) into ``<images_dir>/derivatives/<size>/``, sharded
+like the originals (see blob_store.py), in a compact format so the gallery
+does not have to load full-size PNGs.
+
+Full-size images can also have format variants (e.g. lossless WebP of a
+PNG) under ``<images_dir>/derivatives/variants/``. They are written on the
+first request that negotiates them, see negotiated_image().
+"""
+import os
+import uuid
+from PIL import Image, features
+from blob_store import blob_path, iter_blob_names, shard_dirs
+from image_formats import FORMATS, FORMATS_BY_MIME_TYPE, VARIANT_FORMATS, encode_image, negotiate_format
+
+DERIVATIVE_SIZES = {
+    "thumb": int(os.getenv('THUMBNAIL_SIZE', 256)),
+    "preview": int(os.getenv('PREVIEW_IMAGE_SIZE', 512))
+}
+DERIVATIVE_FORMAT = os.getenv('DERIVATIVE_FORMAT', 'webp').lower()
+DERIVATIVE_QUALITY = int(os.getenv('DERIVATIVE_QUALITY', 80))
+DERIVATIVES_DIRNAME = "derivatives"
+VARIANTS_DIRNAME = "variants"
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+MIME_TYPES = {"webp": "image/webp", "avif": "image/avif"}
+
+
+def derivative_format() -> str:
+    """AVIF when requested and supported by this Pillow build, else WebP"""
+    if DERIVATIVE_FORMAT == "avif" and features.check("avif"):
+        return "avif"
+    return "webp"
+
+
+def derivative_path(images_dir: str, filename: str, size: str) -> str:
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(images_dir, DERIVATIVES_DIRNAME, size, *shard_dirs(filename), f"{stem}.{derivative_format()}")
+
+
+def create_derivatives(images_dir: str, filename: str, sizes=None):
+    """Write any missing derivatives of filename; returns {size: path}"""
+    sizes = sizes or list(DERIVATIVE_SIZES)
+    targets = {size: derivative_path(images_dir, filename, size) for size in sizes}
+    missing = {size: path for size, path in targets.items() if not os.path.exists(path)}
+    if not missing:
+        return targets
+
+    source = blob_path(images_dir, filename)
+    if not os.path.exists(source):
+        return {}
+
+    fmt = derivative_format()
+    with Image.open(source) as image:
+        image.load()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        for size, path in missing.items():
+            copy = image.copy()
+            copy.thumbnail((DERIVATIVE_SIZES[size], DERIVATIVE_SIZES[size]))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so concurrent readers never see a partial file
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            copy.save(tmp_path, format=fmt.upper(), quality=DERIVATIVE_QUALITY)
+            os.replace(tmp_path, path)
+    return targets
+
+
+def get_derivative(images_dir: str, filename: str, size: str):
+    """Return (path, mime type) of a derivative, creating it if needed.
+
+    Returns (None, None) when the source is missing or cannot be decoded.
+    """
+    try:
+        path = create_derivatives(images_dir, filename, [size]).get(size)
+    except OSError as e:
+        print(f"⚠️ Could not create {size} derivative for {filename}: {e}")
+        return None, None
+    if path is None:
+        return None, None
+    return path, MIME_TYPES[derivative_format()]
+
+
+def variant_path(images_dir: str, filename: str, fmt: str) -> str:
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(images_dir, DERIVATIVES_DIRNAME, VARIANTS_DIRNAME, *shard_dirs(filename),
+                        f"{stem}.{FORMATS[fmt][0]}")
+
+
+def create_variant(images_dir: str, filename: str, fmt: str):
+    """Path of filename re-encoded as fmt, writing it if needed; None when that fails"""
+    path = variant_path(images_dir, filename, fmt)
+    if os.path.exists(path):
+        return path
+    try:
+        with Image.open(blob_path(images_dir, filename)) as image:
+            image.load()
+            data = encode_image(image, fmt)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f"⚠️ Could not create {fmt} variant for {filename}: {e}")
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def negotiated_image(metadata_cache, images_dir: str, filename: str, accept: str, load: bool = True):
+    """Metadata of the file to send for a full-size request with this Accept header.
+
+    The stored file, or a variant when the client needs another format or a
+    preferred one is smaller. With load=False only cached metadata is used
+    and None means "call again with load=True" (blocking, run in a thread);
+    with load=True None means the image does not exist.
+    """
+    entry = metadata_cache.get(filename)
+    if entry is None:
+        if not load:
+            return None
+        entry = metadata_cache.load(filename, blob_path(images_dir, filename))
+        if entry is None:
+            return None
+    media_type, required = negotiate_format(accept, entry.media_type)
+    if media_type == entry.media_type:
+        return entry
+    variant = metadata_cache.get(filename, media_type)
+    if variant is None:
+        if not load:
+            return None
+        path = create_variant(images_dir, filename, FORMATS_BY_MIME_TYPE[media_type])
+        if path is None:
+            return entry
+        variant = metadata_cache.load(filename, path, media_type, media_type)
+        if variant is None:
+            return entry
+    if required or variant.stat_result.st_size < entry.stat_result.st_size:
+        return variant
+    return entry
+
+
+def delete_derivatives(images_dir: str, filename: str):
+    paths = [derivative_path(images_dir, filename, size) for size in DERIVATIVE_SIZES]
+    paths += [variant_path(images_dir, filename, fmt) for fmt in VARIANT_FORMATS]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def create_derivatives_safely(images_dir: str, filename: str):
+    """create_derivatives for background use: logs instead of raising"""
+    try:
+        create_derivatives(images_dir, filename)
+        return True
+    except Exception as e:
+        print(f"⚠️ Could not create derivatives for {filename}: {e}")
+        return False
+
+
+def backfill_derivatives(images_dir: str):
+    """Create missing derivatives for every existing image; returns the count"""
+    created = 0
+    for name in iter_blob_names(images_dir):
+        if not name.lower().endswith(SOURCE_EXTENSIONS):
+            continue
+        if all(os.path.exists(derivative_path(images_dir, name, size)) for size in DERIVATIVE_SIZES):
+            continue
+        if create_derivatives_safely(images_dir, name):
+            created += 1
+    if created:
+        print(f"🖼️ Backfilled derivatives for {created} images")
+    return created
@@ -0,0 +1,173 @@
+"""Format detection, compact storage encoding and Accept negotiation for images.
+
+Providers do not always send what a filename suggests (Pollinations answers
+with JPEG), so stored images are identified by their magic bytes and saved
+with the matching extension and MIME type. Lossless sources are re-encoded
+into IMAGE_STORAGE_FORMAT when that makes them smaller:
+
+- original: keep the received bytes
+- png: optimized PNG (default)
+- webp: lossless WebP
+
+Lossy sources (JPEG) are never re-encoded, since a lossless copy of a JPEG
+is only bigger. When serving, negotiate_format() picks between the stored
+file and a lossless variant based on the request's Accept header.
+"""
+import io
+import os
+from collections import namedtuple
+from PIL import Image, features
+
+IMAGE_STORAGE_FORMAT = os.getenv('IMAGE_STORAGE_FORMAT', 'png').lower()
+IMAGE_NEGOTIATE_WEBP = os.getenv('IMAGE_NEGOTIATE_WEBP', 'true').lower() == 'true'
+WEBP_LOSSLESS_EFFORT = 80
+JPEG_QUALITY = 90
+
+# format -> (file extension, MIME type)
+FORMATS = {
+    "png": ("png", "image/png"),
+    "jpeg": ("jpg", "image/jpeg"),
+    "webp": ("webp", "image/webp"),
+    "gif": ("gif", "image/gif"),
+    "avif": ("avif", "image/avif")
+}
+FORMATS_BY_MIME_TYPE = {mime_type: fmt for fmt, (_, mime_type) in FORMATS.items()}
+LOSSLESS_SOURCES = ("png",)
+# Formats a variant can be encoded in, lossless ones first
+VARIANT_FORMATS = ("png", "webp", "jpeg")
+
+StoredImage = namedtuple("StoredImage", ["data", "extension", "mime_type"])
+
+
+def sniff_format(data: bytes):
+    """Format name from the leading bytes of an image, or None"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "avif"
+    return None
+
+
+def sniff_media_type(data: bytes):
+    fmt = sniff_format(data)
+    return FORMATS[fmt][1] if fmt else None
+
+
+def format_supported(fmt: str) -> bool:
+    return fmt != "webp" or features.check("webp")
+
+
+def storage_format() -> str:
+    """IMAGE_STORAGE_FORMAT, falling back to png when this Pillow build lacks WebP"""
+    if IMAGE_STORAGE_FORMAT not in ("original", "png", "webp"):
+        return "png"
+    if not format_supported(IMAGE_STORAGE_FORMAT):
+        return "png"
+    return IMAGE_STORAGE_FORMAT
+
+
+def stored_image(data: bytes, fmt: str):
+    if fmt is None:
+        return StoredImage(data, "bin", "application/octet-stream")
+    extension, mime_type = FORMATS[fmt]
+    return StoredImage(data, extension, mime_type)
+
+
+def encode_image(image, fmt: str) -> bytes:
+    """Encode a PIL image as optimized PNG, lossless WebP or JPEG"""
+    buffer = io.BytesIO()
+    if fmt == "webp":
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        image.save(buffer, format="WEBP", lossless=True, quality=WEBP_LOSSLESS_EFFORT)
+    elif fmt == "jpeg":
+        image.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def prepare_image(data: bytes) -> StoredImage:
+    """Detect the real format of provider bytes and re-encode them if that is smaller (blocking)"""
+    fmt = sniff_format(data)
+    target = storage_format()
+    if fmt in LOSSLESS_SOURCES and target != "original":
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                image.load()
+                encoded = encode_image(image, target)
+            if len(encoded) < len(data):
+                return stored_image(encoded, target)
+        except OSError as e:
+            print(f"⚠️ Keeping image as received, re-encoding failed: {e}")
+    return stored_image(data, fmt)
+
+
+def encode_for_storage(image) -> StoredImage:
+    """Encode a freshly generated PIL image in the storage format (blocking)"""
+    fmt = storage_format()
+    if fmt == "original":
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return stored_image(buffer.getvalue(), "png")
+    return stored_image(encode_image(image, fmt), fmt)
+
+
+def parse_accept(header: str):
+    """{media range: q} from an Accept header"""
+    ranges = {}
+    for part in header.split(","):
+        media_range, *params = [item.strip() for item in part.split(";")]
+        if not media_range:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges[media_range.lower()] = q
+    return ranges
+
+
+def accept_quality(ranges, media_type: str) -> float:
+    """q of the most specific range matching media_type (0 when none does)"""
+    major = media_type.split("/")[0]
+    for media_range in (media_type, f"{major}/*", "*/*"):
+        if media_range in ranges:
+            return ranges[media_range]
+    return 0.0
+
+
+def negotiate_format(accept: str, media_type: str):
+    """(MIME type to send, whether the client needs it) for a stored image of media_type.
+
+    A client that names image/webp is offered lossless WebP for a PNG (same
+    pixels, fewer bytes; the caller only uses it when it is smaller). A
+    client that does not accept the stored type at all gets a variant it does
+    accept. Without an Accept header the stored file is sent.
+    """
+    if not accept or media_type not in FORMATS_BY_MIME_TYPE:
+        return media_type, False
+    ranges = parse_accept(accept)
+    stored_q = accept_quality(ranges, media_type)
+    webp_q = ranges.get("image/webp", 0.0)
+    if (media_type == "image/png" and IMAGE_NEGOTIATE_WEBP and webp_q > 0 and webp_q >= stored_q
+            and format_supported("webp")):
+        return "image/webp", False
+    if stored_q > 0:
+        return media_type, False
+    for fmt in VARIANT_FORMATS:
+        candidate = FORMATS[fmt][1]
+        if accept_quality(ranges, candidate) > 0 and format_supported(fmt):
+            return candidate, True
+    # Nothing acceptable: sending the image beats a 406 for an <img>
+    return media_type, False
@@ -0,0 +1,128 @@
+"""Cache-friendly serving of generated images.
+
+Generated images and their derivatives never change once written, so they
+are served with a strong content-hash ETag and a long-lived immutable
+Cache-Control. Conditional requests (If-None-Match / If-Modified-Since) get
+a 304, and byte ranges are handled by Starlette's FileResponse.
+
+File metadata (stat result, hash and the media type sniffed from the
+file's leading bytes) is kept in memory, so repeat requests do not touch the
+filesystem until the file is sent. Full-size images may be negotiated
+against the Accept header (see image_formats.py); those responses carry
+``Vary: Accept``.
+"""
+import hashlib
+import os
+import stat
+import threading
+from collections import OrderedDict, namedtuple
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+from image_formats import sniff_media_type
+
+IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', 365 * 24 * 3600))
+IMAGE_METADATA_CACHE_SIZE = int(os.getenv('IMAGE_METADATA_CACHE_SIZE', 4096))
+IMAGE_CACHE_CONTROL = f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable"
+
+ImageMetadata = namedtuple("ImageMetadata", ["path", "stat_result", "etag", "media_type"])
+
+
+def read_metadata(path: str, media_type: str = None):
+    """Stat and hash path; returns None when it is not a regular file.
+
+    Without a media_type it is sniffed from the content, so legacy files whose
+    extension does not match their format are still labelled correctly.
+    """
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            if media_type is None:
+                media_type = sniff_media_type(chunk) or "application/octet-stream"
+            digest.update(chunk)
+    return ImageMetadata(path, stat_result, f'"{digest.hexdigest()[:32]}"', media_type)
+
+
+class ImageMetadataCache:
+    """LRU of (filename, size) -> ImageMetadata"""
+
+    def __init__(self, max_entries: int = IMAGE_METADATA_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename: str, size: str = "full"):
+        """Cached metadata, or None; never touches the filesystem"""
+        with self._lock:
+            entry = self._entries.get((filename, size))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((filename, size))
+            self.hits += 1
+            return entry
+
+    def load(self, filename: str, path: str, size: str = "full", media_type: str = None):
+        """Read metadata from disk and cache it; blocking, run in a thread"""
+        entry = read_metadata(path, media_type)
+        if entry is None:
+            return None
+        with self._lock:
+            self._entries[(filename, size)] = entry
+            self._entries.move_to_end((filename, size))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, filename: str):
+        """Forget every size of filename (call when it is deleted)"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == filename]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+def is_not_modified(request: Request, entry: ImageMetadata) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or entry.etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(entry.stat_result.st_mtime) <= since
+    return False
+
+
+def image_response(request: Request, entry: ImageMetadata, vary: str = None):
+    """304 when the client copy is current, else the file (ranges supported)"""
+    headers = {"ETag": entry.etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if vary:
+        headers["Vary"] = vary
+    if is_not_modified(request, entry):
+        headers["Last-Modified"] = formatdate(entry.stat_result.st_mtime, usegmt=True)
+        return Response(status_code=304, headers=headers)
+    return FileResponse(entry.path, media_type=entry.media_type, headers=headers, stat_result=entry.stat_result)
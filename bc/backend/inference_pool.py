@@ -0,0 +1,103 @@
+"""Pool of CPU inference worker processes.
+
+Each worker process loads its own pipeline and pins its intra-op thread
+count, so a many-core box can run several generations side by side
+(e.g. 4 workers x 8 threads) while the FastAPI process only dispatches.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', 0))
+INFERENCE_THREADS_PER_WORKER = int(os.getenv('INFERENCE_THREADS_PER_WORKER', 0))
+
+# Pipeline owned by the current worker process
+_worker_pipe = None
+# Startup barrier shared by all workers, see InferencePool.start
+_ready_barrier = None
+
+
+def _init_worker(threads: int, ready_barrier):
+    global _worker_pipe, _ready_barrier
+    _ready_barrier = ready_barrier
+    import torch
+    from sd_pipeline import WARMUP_ON_START, load_pipeline, warm_up_pipeline
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    print(f"🧵 Inference worker {os.getpid()} loading model with {threads} threads...")
+    _worker_pipe = load_pipeline("cpu")
+    if WARMUP_ON_START:
+        warm_up_pipeline(_worker_pipe)
+    print(f"✅ Inference worker {os.getpid()} ready")
+
+
+def _worker_ready():
+    # Block until every worker got here, so each startup call lands in a different process
+    _ready_barrier.wait()
+    return os.getpid()
+
+
+def _worker_run_batch(params: dict, prompts, seed):
+    from sd_pipeline import embedding_cache_stats, run_pipeline_batch
+    images = run_pipeline_batch(_worker_pipe, prompts, seed=seed, **params)
+    return os.getpid(), images, embedding_cache_stats()
+
+
+class InferencePool:
+    """Dispatch pipeline batches to a pool of worker processes"""
+
+    def __init__(self, workers: int = INFERENCE_WORKERS, threads_per_worker: int = INFERENCE_THREADS_PER_WORKER):
+        self.workers = max(1, workers)
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers)
+        # spawn, not fork: torch thread pools do not survive a fork
+        context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.threads_per_worker, context.Barrier(self.workers))
+        )
+        self._embedding_stats = {}
+        self.worker_pids = []
+
+    def start(self):
+        """Start every worker and block until all have loaded the model; returns their pids"""
+        print(f"🚀 Starting {self.workers} inference workers x {self.threads_per_worker} threads")
+        # Each call waits at the barrier until all workers have loaded, so a worker that
+        # finished early cannot answer for the ones still starting
+        futures = [self._executor.submit(_worker_ready) for _ in range(self.workers)]
+        self.worker_pids = sorted({future.result() for future in futures})
+        print(f"✅ Inference workers ready: pids {', '.join(map(str, self.worker_pids))}")
+        return self.worker_pids
+
+    def run_batch(self, params: dict, prompts, seed=None):
+        """Run one batch on a free worker (blocking) and return its images"""
+        pid, images, embedding_stats = self._executor.submit(_worker_run_batch, params, list(prompts), seed).result()
+        if embedding_stats is not None:
+            self._embedding_stats[pid] = embedding_stats
+        return images
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "worker_pids": self.worker_pids,
+            "embedding_cache": self.embedding_cache_stats()
+        }
+
+    def embedding_cache_stats(self):
+        """Embedding cache counters summed over workers (as of their last batch)"""
+        if not self._embedding_stats:
+            return None
+        totals = {}
+        for stats in list(self._embedding_stats.values()):
+            for name in ("entries", "bytes", "hits", "misses", "deduplicated", "evictions", "encode_seconds",
+                         "saved_seconds"):
+                totals[name] = round(totals.get(name, 0) + stats[name], 3)
+        lookups = totals["hits"] + totals["misses"]
+        totals["hit_rate"] = round(totals["hits"] / lookups, 4) if lookups else 0.0
+        return totals
@@ -0,0 +1,114 @@
+"""Bounded thread pools for blocking disk and image work.
+
+Writes, unlinks and PNG/derivative encoding run on ``write_executor``;
+file reads on the image serving path run on ``read_executor``. Neither runs
+on the event loop, and because the pools are separate, serving images never
+waits behind a burst of large writes. Each pool admits at most
+IO_MAX_PENDING calls (running plus queued); further callers wait for a slot,
+which bounds the memory held by buffered writes.
+"""
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+IO_WRITE_WORKERS = int(os.getenv('IO_WRITE_WORKERS', 4))
+IO_READ_WORKERS = int(os.getenv('IO_READ_WORKERS', 8))
+IO_MAX_PENDING = int(os.getenv('IO_MAX_PENDING', 256))
+
+
+class IOExecutor:
+    """Thread pool with admission control and queue-depth metrics"""
+
+    def __init__(self, name: str, max_workers: int, max_pending: int = IO_MAX_PENDING):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max(self.max_workers, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._slots = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.waiting_for_slot = 0
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the pool and return its result"""
+        if self._slots is None:
+            # Created on first use so it belongs to the server's event loop
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self.waiting_for_slot += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting_for_slot -= 1
+        try:
+            with self._lock:
+                self.pending += 1
+                self.max_queue_depth = max(self.max_queue_depth, self.pending - self.running)
+            call = functools.partial(self._call, fn, args, kwargs, time.perf_counter())
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        """Wait for submitted work to finish (blocking; servers use shutdown_io_executors)"""
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                "workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "running": self.running,
+                "queued": self.pending - self.running,
+                "waiting_for_slot": self.waiting_for_slot,
+                "max_queue_depth": self.max_queue_depth,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait_ms": round(self.wait_seconds / finished * 1000, 2) if finished else 0.0,
+                "avg_run_ms": round(self.run_seconds / finished * 1000, 2) if finished else 0.0
+            }
+
+    def _call(self, fn, args, kwargs, submitted):
+        start = time.perf_counter()
+        with self._lock:
+            self.running += 1
+            self.wait_seconds += start - submitted
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.pending -= 1
+                self.run_seconds += time.perf_counter() - start
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+
+write_executor = IOExecutor("io-write", IO_WRITE_WORKERS)
+read_executor = IOExecutor("io-read", IO_READ_WORKERS)
+
+
+def io_stats():
+    return {"writes": write_executor.stats(), "reads": read_executor.stats()}
+
+
+async def shutdown_io_executors():
+    """Drain both pools without blocking the event loop (call at shutdown)"""
+    await asyncio.gather(
+        asyncio.to_thread(write_executor.shutdown),
+        asyncio.to_thread(read_executor.shutdown)
+    )
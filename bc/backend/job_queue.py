@@ -0,0 +1,178 @@
+"""Persistent job queue for long-running generations.
+
+Jobs are stored in the ``jobs`` table of the images database so queued and
+interrupted work is picked up again after a restart. A bounded pool of
+worker tasks processes the queue in submission order.
+"""
+import asyncio
+import json
+import os
+import uuid
+from datetime import datetime
+from sqlite_pool import SQLitePool
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_QUEUE_MAX = int(os.getenv('JOB_QUEUE_MAX', 100))
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """Submit/poll/fetch job queue backed by SQLite.
+
+    handler is an async callable taking the job parameters and returning a
+    JSON-serializable result.
+    """
+
+    def __init__(self, database_path: str, handler, workers: int = JOB_WORKERS,
+                 max_queued: int = JOB_QUEUE_MAX):
+        self.database_path = database_path
+        self.pool = SQLitePool(database_path)
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self._queue = None
+        self._order = []
+        self._tasks = []
+        self.completed = 0
+        self.failed = 0
+
+    def get_db_connection(self):
+        return self.pool.connection()
+
+    def init_table(self):
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at TIMESTAMP NOT NULL,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+        conn.commit()
+        conn.close()
+
+    async def start(self):
+        """Create the table, requeue unfinished jobs and start the workers"""
+        self.init_table()
+        self._queue = asyncio.Queue()
+
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        # Jobs that were running when the process stopped start over
+        cursor.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+        conn.commit()
+        cursor.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at")
+        for (job_id,) in cursor.fetchall():
+            self._enqueue(job_id)
+        conn.close()
+
+        if self._order:
+            print(f"📋 Resumed {len(self._order)} queued jobs")
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.pool.close_all()
+
+    def submit(self, params: dict):
+        """Persist a new job and queue it; returns its status"""
+        if len(self._order) >= self.max_queued:
+            raise QueueFullError(f"Job queue is full ({self.max_queued} jobs)")
+
+        job_id = uuid.uuid4().hex
+        conn = self.get_db_connection()
+        conn.execute(
+            "INSERT INTO jobs (id, status, params, created_at) VALUES (?, 'queued', ?, ?)",
+            (job_id, json.dumps(params), datetime.now().isoformat())
+        )
+        conn.commit()
+        conn.close()
+
+        self._enqueue(job_id)
+        return self.get(job_id)
+
+    def get(self, job_id: str):
+        """Return the job's status, queue position and result, or None"""
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, status, result, error, created_at, started_at, finished_at
+            FROM jobs WHERE id = ?
+        ''', (job_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return None
+
+        return {
+            "job_id": row[0],
+            "status": row[1],
+            "position": self._order.index(job_id) + 1 if job_id in self._order else None,
+            "result": json.loads(row[2]) if row[2] else None,
+            "error": row[3],
+            "created_at": row[4],
+            "started_at": row[5],
+            "finished_at": row[6]
+        }
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": len(self._order),
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+    def _enqueue(self, job_id: str):
+        self._order.append(job_id)
+        self._queue.put_nowait(job_id)
+
+    def _update(self, job_id: str, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        conn = self.get_db_connection()
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+        conn.close()
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._order.remove(job_id)
+
+            conn = self.get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT params FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            conn.close()
+            if row is None:
+                continue
+
+            self._update(job_id, status="running", started_at=datetime.now().isoformat())
+            print(f"⚙️ Job {job_id[:8]} started")
+            try:
+                result = await self.handler(json.loads(row[0]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Job {job_id[:8]} failed: {e}")
+                self.failed += 1
+                self._update(job_id, status="failed", error=str(e), finished_at=datetime.now().isoformat())
+                continue
+
+            self.completed += 1
+            self._update(job_id, status="done", result=json.dumps(result), finished_at=datetime.now().isoformat())
+            print(f"✅ Job {job_id[:8]} finished")
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import httpx
@@ -6,9 +6,16 @@ import base64
 import os
 from dotenv import load_dotenv
 from typing import Optional
-from fastapi.responses import FileResponse
 from datetime import datetime
-import json
+from generation_cache import GenerationCache, make_cache_key
+from http_client import get_http_client, close_http_client
+from response_modes import build_generate_response, validate_response_mode
+from image_serving import ImageMetadataCache, image_response
+from image_formats import prepare_image
+from image_derivatives import delete_derivatives, negotiated_image
+from history_store import HistoryStore
+from blob_store import BlobStore
+from io_executor import io_stats, read_executor, shutdown_io_executors, write_executor
 
 # Load environment variables
 load_dotenv()
@@ -30,15 +37,37 @@ HISTORY_FILE = "image_history.json"
 # Create directories if they don't exist
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
-def load_image_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, 'r') as f:
-            return json.load(f)
-    return []
+blob_store = BlobStore(IMAGES_DIR)
+generation_cache = GenerationCache(IMAGES_DIR)
+image_metadata = ImageMetadataCache()
+history_store = HistoryStore(HISTORY_FILE)
 
-def save_image_history(history):
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2, default=str)
+def store_image(image_bytes, image_id, prompt):
+    """Save an image and its history record; returns (filename, stored image) (blocking)"""
+    # Stored under its real format, recompressed when that is smaller
+    stored = prepare_image(image_bytes)
+    with blob_store.reference_lock:
+        filename = blob_store.put(stored.data, stored.extension)
+        history_store.append({
+            "id": image_id,
+            "filename": filename,
+            "prompt": prompt,
+            "created_at": datetime.now().isoformat(),
+            "mime_type": stored.mime_type,
+            "file_size": len(stored.data),
+            "url": f"/api/images/{filename}"
+        })
+    return filename, stored
+
+def delete_stored_image(image_id):
+    """Remove a history record, and its file once no record uses it; returns the record (blocking)"""
+    with blob_store.reference_lock:
+        record = history_store.delete(image_id)
+        # Images are deduplicated, so another record may still point at the file
+        if record and not history_store.filename_refs(record["filename"]):
+            blob_store.remove(record["filename"])
+            delete_derivatives(IMAGES_DIR, record["filename"])
+    return record
 
 class ImageRequest(BaseModel):
     prompt: str
@@ -47,11 +76,24 @@ class ImageRequest(BaseModel):
     cfg_scale: float = 7.0
     steps: int = 30
     samples: int = 1
+    use_cache: bool = True
+    response_mode: str = "base64"  # base64, url or binary
 
 class ImageResponse(BaseModel):
     status: str
     image: Optional[str] = None
     error: Optional[str] = None
+    cached: Optional[bool] = None
+    image_id: Optional[str] = None
+    filename: Optional[str] = None
+    mime_type: Optional[str] = None
+    url: Optional[str] = None
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_client()
+    await shutdown_io_executors()
+    history_store.compact()
 
 @app.get("/")
 async def root():
@@ -68,12 +110,38 @@ async def health_check():
 
 @app.post("/api/generate", response_model=ImageResponse)
 async def generate_image(request: ImageRequest):
+    validate_response_mode(request.response_mode)
     try:
         # Get API key from environment
         api_key = os.getenv("STABILITY_API_KEY")
         if not api_key:
             raise HTTPException(status_code=500, detail="Stability AI API key not configured")
         
+        cache_key = make_cache_key(
+            request.prompt,
+            width=request.width,
+            height=request.height,
+            cfg_scale=request.cfg_scale,
+            steps=request.steps,
+            samples=request.samples,
+            provider="stability"
+        )
+        if request.use_cache:
+            cached = generation_cache.get(cache_key)
+            if cached:
+                payload = {
+                    "status": "success",
+                    "cached": True,
+                    "image_id": cached["image_id"],
+                    "filename": cached["filename"],
+                    "mime_type": cached.get("mime_type"),
+                    "url": f"/api/images/{cached['filename']}"
+                }
+                return await read_executor.run(
+                    build_generate_response, request.response_mode, payload,
+                    image_path=blob_store.path(cached["filename"]), media_type=cached.get("mime_type") or "image/png"
+                )
+        
         # Stability AI API endpoint
         url = "https://api.stability.ai/v1/generation/stable-diffusion-v1-6/text-to-image"
         
@@ -92,79 +160,75 @@ async def generate_image(request: ImageRequest):
             "samples": request.samples,
         }
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(url, headers=headers, json=data)
+        response = await get_http_client().post(url, headers=headers, json=data, timeout=60.0)
+        
+        if response.status_code != 200:
+            error_detail = f"Stability AI API error: {response.status_code} - {response.text}"
+            raise HTTPException(status_code=response.status_code, detail=error_detail)
+        
+        response_data = response.json()
+        
+        # Extract the base64 image
+        if "artifacts" in response_data and len(response_data["artifacts"]) > 0:
+            image_base64 = response_data["artifacts"][0]["base64"]
+            image_bytes = base64.b64decode(image_base64)
             
-            if response.status_code != 200:
-                error_detail = f"Stability AI API error: {response.status_code} - {response.text}"
-                raise HTTPException(status_code=response.status_code, detail=error_detail)
+            # Save the decoded PNG (not the JSON response body) and its history record off the event loop
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]  # Include milliseconds
+            filename, stored = await write_executor.run(store_image, image_bytes, timestamp, request.prompt)
+            generation_cache.put(cache_key, filename, len(stored.data), image_id=timestamp, mime_type=stored.mime_type)
             
-            response_data = response.json()
+            payload = {
+                "status": "success",
+                "cached": False,
+                "image_id": timestamp,
+                "filename": filename,
+                "mime_type": stored.mime_type,
+                "url": f"/api/images/{filename}"
+            }
+            if request.response_mode == "base64" and stored.data is image_bytes:
+                # Stability already sent base64 of the stored bytes, so reuse it instead of re-encoding
+                return {**payload, "image": image_base64}
+            return build_generate_response(request.response_mode, payload, image_data=stored.data, media_type=stored.mime_type)
+        else:
+            raise HTTPException(status_code=500, detail="No image generated")
             
-            # Extract the base64 image
-            if "artifacts" in response_data and len(response_data["artifacts"]) > 0:
-                image_base64 = response_data["artifacts"][0]["base64"]
-                
-                # Save image to file
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"image_{timestamp}.png"
-                filepath = os.path.join(IMAGES_DIR, filename)
-                
-                with open(filepath, "wb") as f:
-                    f.write(response.content)
-                
-                # Save to history
-                history = load_image_history()
-                image_record = {
-                    "id": timestamp,
-                    "filename": filename,
-                    "prompt": request.prompt,
-                    "created_at": datetime.now().isoformat(),
-                    "url": f"/api/images/{filename}"
-                }
-                history.append(image_record)
-                save_image_history(history)
-                
-                # Return base64 for immediate display
-                encoded_image = base64.b64encode(response.content).decode('utf-8')
-                return {"status": "success", "image": encoded_image}
-            else:
-                raise HTTPException(status_code=500, detail="No image generated")
-                
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Request timeout")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+@app.get("/api/stats")
+async def get_stats():
+    return {
+        "generation_cache": generation_cache.stats(),
+        "history": history_store.stats(),
+        "blob_store": blob_store.stats(),
+        "io": io_stats()
+    }
+
 @app.get("/api/history")
 async def get_image_history():
-    history = load_image_history()
-    return {"images": history}
+    return {"images": history_store.list()}
 
 @app.get("/api/images/{filename}")
-async def get_image(filename: str):
-    filepath = os.path.join(IMAGES_DIR, filename)
-    if os.path.exists(filepath):
-        return FileResponse(filepath)
-    raise HTTPException(status_code=404, detail="Image not found")
+async def get_image(filename: str, request: Request):
+    # Negotiated against the Accept header, see negotiated_image()
+    accept = request.headers.get("accept")
+    entry = negotiated_image(image_metadata, IMAGES_DIR, filename, accept, load=False) or await read_executor.run(
+        negotiated_image, image_metadata, IMAGES_DIR, filename, accept
+    )
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return image_response(request, entry, vary="Accept")
 
 @app.delete("/api/history/{image_id}")
 async def delete_image(image_id: str):
-    history = load_image_history()
-    image_to_delete = None
-    
-    for i, img in enumerate(history):
-        if img["id"] == image_id:
-            image_to_delete = history.pop(i)
-            break
+    image_to_delete = await write_executor.run(delete_stored_image, image_id)
     
     if image_to_delete:
-        # Delete physical file
-        filepath = os.path.join(IMAGES_DIR, image_to_delete["filename"])
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        
-        save_image_history(history)
+        generation_cache.invalidate_filename(image_to_delete["filename"])
+        image_metadata.invalidate(image_to_delete["filename"])
         return {"status": "success", "message": "Image deleted"}
     
     raise HTTPException(status_code=404, detail="Image not found")
\ No newline at end of file
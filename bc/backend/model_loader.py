@@ -0,0 +1,71 @@
+"""Background model loading with a readiness state and timed startup phases.
+
+The server starts accepting traffic immediately: /health reports liveness
+while the model loads (and optionally warms up) in a worker thread, and
+readiness flips once the model can serve requests.
+"""
+import asyncio
+import time
+
+
+class ModelLoader:
+    """Run load and warm-up functions in the background and track their state"""
+
+    def __init__(self):
+        self.state = "pending"
+        self.error = None
+        self.phases = {}
+        self._ready_event = None
+        self._task = None
+
+    def start(self, load_fn, warmup_fn=None):
+        """Schedule loading on the running event loop and return immediately"""
+        self._ready_event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run(load_fn, warmup_fn))
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    async def wait_ready(self) -> bool:
+        """Wait until loading has finished; returns whether the model is ready"""
+        if self._ready_event is not None:
+            await self._ready_event.wait()
+        return self.ready
+
+    def status(self):
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "error": self.error,
+            "phases": dict(self.phases)
+        }
+
+    async def _run(self, load_fn, warmup_fn):
+        start = time.perf_counter()
+        try:
+            self.state = "loading"
+            await self._phase("load", load_fn)
+            if warmup_fn is not None:
+                self.state = "warming_up"
+                try:
+                    await self._phase("warmup", warmup_fn)
+                except Exception as e:
+                    # A failed warm-up only costs first-request latency
+                    print(f"⚠️ Warm-up failed: {e}")
+            self.state = "ready"
+            print(f"✅ Model ready in {time.perf_counter() - start:.2f} seconds")
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"❌ Error loading model: {e}")
+        finally:
+            self.phases["total_seconds"] = round(time.perf_counter() - start, 3)
+            self._ready_event.set()
+
+    async def _phase(self, name, fn):
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(fn)
+        finally:
+            self.phases[f"{name}_seconds"] = round(time.perf_counter() - start, 3)
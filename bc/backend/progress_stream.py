@@ -0,0 +1,40 @@
+"""Step progress and cheap latent previews for streamed generations."""
+import base64
+import io
+import json
+import os
+import torch
+from PIL import Image
+
+PREVIEW_EVERY_N_STEPS = int(os.getenv('PREVIEW_EVERY_N_STEPS', 2))
+PREVIEW_SIZE = int(os.getenv('PREVIEW_SIZE', 128))
+
+# Approximate linear projection of SD 1.x latent channels to RGB. Far
+# cheaper than a VAE decode and good enough to show composition.
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+
+def latents_to_preview(latents, size: int = PREVIEW_SIZE) -> str:
+    """Project the first latent of a batch to a small base64 JPEG"""
+    latent = latents[0].float().cpu()
+    factors = torch.tensor(LATENT_RGB_FACTORS)
+    rgb = torch.einsum("chw,cr->hwr", latent, factors)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).byte().numpy()
+
+    image = Image.fromarray(rgb)
+    scale = size / max(image.size)
+    image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=70)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
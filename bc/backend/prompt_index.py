@@ -0,0 +1,157 @@
+"""In-memory similarity index over stored prompts.
+
+Prompts are embedded as L2-normalized hashed bag-of-words + character
+trigram vectors, which match near-duplicates such as "a red fox in snow"
+and "red fox in the snow, photo" without a model. Lookups are a single
+NumPy matrix-vector product over all stored prompts.
+
+The index is updated on every insert and delete. Snapshots are written to
+PROMPT_INDEX_PATH with an atomic rename, so startup loads the matrix and
+only reconciles rows added or removed since the last snapshot.
+"""
+import os
+import re
+import threading
+import uuid
+import zlib
+import numpy as np
+from generation_cache import normalize_prompt
+
+PROMPT_INDEX_DIM = int(os.getenv('PROMPT_INDEX_DIM', 256))
+PROMPT_INDEX_PATH = os.getenv('PROMPT_INDEX_PATH', 'prompt_index.npz')
+PROMPT_INDEX_SNAPSHOT_SECONDS = int(os.getenv('PROMPT_INDEX_SNAPSHOT_SECONDS', 300))
+
+STOPWORDS = frozenset("a an and the of in on at to with for by from is are".split())
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+TRIGRAM_WEIGHT = 0.5
+
+
+def _bucket(feature: str, dim: int):
+    """Stable (index, sign) for a feature; Python's hash() is salted per process"""
+    h = zlib.crc32(feature.encode())
+    return h % dim, 1.0 if (h >> 31) & 1 else -1.0
+
+
+def embed_prompt(prompt: str, dim: int = PROMPT_INDEX_DIM):
+    """Unit-length float32 vector for prompt (all zeros if it has no words)"""
+    vector = np.zeros(dim, dtype=np.float32)
+    words = [word for word in WORD_PATTERN.findall(normalize_prompt(prompt)) if word not in STOPWORDS]
+    for word in words:
+        index, sign = _bucket(f"w:{word}", dim)
+        vector[index] += sign
+        padded = f"<{word}>"
+        for i in range(len(padded) - 2):
+            index, sign = _bucket(f"t:{padded[i:i + 3]}", dim)
+            vector[index] += sign * TRIGRAM_WEIGHT
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class PromptIndex:
+    """Growable matrix of prompt embeddings keyed by image id"""
+
+    def __init__(self, dim: int = PROMPT_INDEX_DIM, path: str = PROMPT_INDEX_PATH):
+        self.dim = dim
+        self.path = path
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._rows = {}
+        self._size = 0
+        self.dirty = False
+
+    def __len__(self):
+        return self._size
+
+    def add(self, image_id: int, prompt: str):
+        vector = embed_prompt(prompt, self.dim)
+        with self._lock:
+            row = self._rows.get(image_id)
+            if row is None:
+                if self._size == len(self._ids):
+                    self._grow()
+                row = self._size
+                self._size += 1
+                self._rows[image_id] = row
+                self._ids[row] = image_id
+            self._vectors[row] = vector
+            self.dirty = True
+
+    def remove(self, image_id: int):
+        with self._lock:
+            row = self._rows.pop(image_id, None)
+            if row is None:
+                return
+            # Move the last row into the hole so the live rows stay contiguous
+            last = self._size - 1
+            if row != last:
+                moved_id = int(self._ids[last])
+                self._vectors[row] = self._vectors[last]
+                self._ids[row] = moved_id
+                self._rows[moved_id] = row
+            self._size -= 1
+            self.dirty = True
+
+    def search(self, prompt: str, k: int = 5, min_score: float = 0.0):
+        """Top-k (image_id, cosine similarity) pairs, best first"""
+        query = embed_prompt(prompt, self.dim)
+        with self._lock:
+            if not self._size or not query.any():
+                return []
+            scores = self._vectors[:self._size] @ query
+            ids = self._ids[:self._size].copy()
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), round(float(scores[i]), 4)) for i in top if scores[i] >= min_score]
+
+    def save(self):
+        """Write a snapshot atomically (temp file + rename)"""
+        with self._lock:
+            vectors = self._vectors[:self._size].copy()
+            ids = self._ids[:self._size].copy()
+            self.dirty = False
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp.npz"
+        np.savez(tmp_path, ids=ids, vectors=vectors)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Load the snapshot if one exists with matching dimensions; returns the row count"""
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            with np.load(self.path) as snapshot:
+                ids, vectors = snapshot["ids"], snapshot["vectors"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Ignoring unreadable prompt index snapshot: {e}")
+            return 0
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            return 0
+        with self._lock:
+            self._vectors = vectors.astype(np.float32)
+            self._ids = ids.astype(np.int64)
+            self._size = len(ids)
+            self._rows = {int(image_id): row for row, image_id in enumerate(self._ids)}
+            self.dirty = False
+        return self._size
+
+    def ids(self):
+        with self._lock:
+            return set(self._rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "prompts": self._size,
+                "dim": self.dim,
+                "memory_bytes": int(self._vectors.nbytes),
+                "unsaved_changes": self.dirty
+            }
+
+    def _grow(self):
+        capacity = max(1024, 2 * len(self._ids))
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:self._size] = self._vectors[:self._size]
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[:self._size] = self._ids[:self._size]
+        self._vectors, self._ids = vectors, ids
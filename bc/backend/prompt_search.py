@@ -0,0 +1,72 @@
+"""FTS5 full-text search over prompts.
+
+An external-content FTS5 table indexes the ``prompt`` column of a table
+without storing a second copy of the text. Triggers keep it in step with
+inserts, deletes (including retention) and prompt updates. Results are
+ranked with bm25 and the last search term matches as a prefix, so partial
+words work while typing.
+"""
+import re
+
+SCHEMA = '''
+    BEGIN IMMEDIATE;
+
+    CREATE VIRTUAL TABLE {fts} USING fts5(
+        prompt,
+        content='{table}',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    );
+
+    CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO {fts} (rowid, prompt) VALUES (NEW.id, NEW.prompt);
+    END;
+
+    CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO {fts} ({fts}, rowid, prompt) VALUES ('delete', OLD.id, OLD.prompt);
+    END;
+
+    CREATE TRIGGER {fts}_update AFTER UPDATE OF prompt ON {table} BEGIN
+        INSERT INTO {fts} ({fts}, rowid, prompt) VALUES ('delete', OLD.id, OLD.prompt);
+        INSERT INTO {fts} (rowid, prompt) VALUES (NEW.id, NEW.prompt);
+    END;
+
+    -- Index the rows that existed before search was enabled
+    INSERT INTO {fts} ({fts}) VALUES ('rebuild');
+
+    COMMIT;
+'''
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def fts5_available(conn) -> bool:
+    return bool(conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0])
+
+
+def init_prompt_search(conn, table: str, fts: str = None) -> bool:
+    """Create the FTS index and triggers for table once; returns False without FTS5"""
+    fts = fts or f"{table}_fts"
+    if not fts5_available(conn):
+        print(f"⚠️ SQLite was built without FTS5, prompt search on {table} is disabled")
+        return False
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,)).fetchone()
+    if not exists:
+        conn.executescript(SCHEMA.format(table=table, fts=fts))
+        print(f"🔎 Prompt search index built for {table}")
+    return True
+
+
+def build_match_query(query: str):
+    """Turn free text into a safe FTS5 query: all words must match, the last one as a prefix.
+
+    Returns None when the text has no searchable words.
+    """
+    tokens = TOKEN_PATTERN.findall(query)
+    if not tokens:
+        return None
+    # Quoting keeps FTS5 operators and punctuation in user input literal
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += "*"
+    return " ".join(terms)
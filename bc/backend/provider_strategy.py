@@ -0,0 +1,154 @@
+"""Strategies for choosing between upstream image providers.
+
+- sequential: try each provider to completion, in order (original behaviour)
+- hedged: start the next provider once the current one is slower than its
+  recent p95 latency; the first success wins and the others are cancelled
+- race: start every provider at once; the first success wins
+"""
+import asyncio
+import os
+import time
+from collections import deque
+
+PROVIDER_STRATEGY = os.getenv('PROVIDER_STRATEGY', 'sequential').lower()
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 10))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 0.5))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 10))
+PROVIDER_LATENCY_WINDOW = int(os.getenv('PROVIDER_LATENCY_WINDOW', 200))
+
+STRATEGIES = ("sequential", "hedged", "race")
+
+
+class LatencyHistogram:
+    """Rolling window of call latencies for one provider.
+
+    Calls cancelled after losing a hedge or race are recorded with their
+    elapsed time as a lower bound; leaving them out would keep only the
+    fast calls and bias the percentiles (and the hedge delay) low.
+    """
+
+    def __init__(self, window: int = PROVIDER_LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self.cancelled = 0
+
+    def record(self, seconds: float, ok: bool):
+        if ok:
+            self.samples.append(seconds)
+            self.successes += 1
+        else:
+            self.failures += 1
+
+    def record_cancelled(self, seconds: float):
+        """A call abandoned after seconds: the real latency was at least that"""
+        self.samples.append(seconds)
+        self.cancelled += 1
+
+    def percentile(self, p: float):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self):
+        def rounded(value):
+            return round(value, 3) if value is not None else None
+        return {
+            "samples": len(self.samples),
+            "successes": self.successes,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "p50_seconds": rounded(self.percentile(50)),
+            "p95_seconds": rounded(self.percentile(95)),
+            "p99_seconds": rounded(self.percentile(99))
+        }
+
+
+class ProviderRunner:
+    """Run a prioritized list of providers using the configured strategy"""
+
+    def __init__(self, strategy: str = PROVIDER_STRATEGY):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown provider strategy: {strategy}")
+        self.strategy = strategy
+        self.histograms = {}
+        self.hedges_started = 0
+
+    def hedge_delay(self, name: str) -> float:
+        """Seconds to wait on provider name before starting the next one"""
+        histogram = self.histograms.get(name)
+        if histogram is None or len(histogram.samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, histogram.percentile(HEDGE_PERCENTILE))
+
+    async def run(self, providers):
+        """Run providers, a list of (name, async fn), and return (name, result)"""
+        queue = list(providers)
+        pending = set()
+        errors = []
+
+        def launch():
+            name, fn = queue.pop(0)
+            pending.add(asyncio.ensure_future(self._timed(name, fn)))
+            return name
+
+        try:
+            current = launch()
+            while self.strategy == "race" and queue:
+                launch()
+
+            while pending:
+                timeout = None
+                if self.strategy == "hedged" and queue:
+                    timeout = self.hedge_delay(current)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    print(f"⏱️ {current} slower than {timeout:.1f}s, hedging with {queue[0][0]}")
+                    self.hedges_started += 1
+                    current = launch()
+                    continue
+
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(str(task.exception()))
+                    print(f"⚠️ Provider failed: {task.exception()}")
+
+                # A failure hands over to the next provider straight away
+                if queue:
+                    current = launch()
+
+            raise Exception(f"All providers failed: {'; '.join(errors)}")
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "strategy": self.strategy,
+            "hedges_started": self.hedges_started,
+            "providers": {
+                name: {**histogram.stats(), "hedge_delay_seconds": round(self.hedge_delay(name), 3)}
+                for name, histogram in self.histograms.items()
+            }
+        }
+
+    async def _timed(self, name, fn):
+        histogram = self.histograms.setdefault(name, LatencyHistogram())
+        start = time.perf_counter()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # Lost a hedge or race: still a sample of how slow this call was
+            histogram.record_cancelled(time.perf_counter() - start)
+            raise
+        except Exception as e:
+            histogram.record(time.perf_counter() - start, ok=False)
+            raise Exception(f"{name}: {e}") from e
+        histogram.record(time.perf_counter() - start, ok=True)
+        return name, result
@@ -0,0 +1,46 @@
+"""Response modes for /api/generate.
+
+- base64: JSON with the image inlined as base64 (default, what the UI expects)
+- url: JSON with only the id/filename/URL of the stored image
+- binary: the raw image bytes, with metadata in X-Image-* headers
+"""
+import base64
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, Response
+
+RESPONSE_MODES = ("base64", "url", "binary")
+# Servers that do not store images have no URL to return
+UNSTORED_RESPONSE_MODES = ("base64", "binary")
+
+# Payload fields that are also sent as headers in binary mode
+HEADER_FIELDS = ("image_id", "filename", "url", "cached", "provider")
+
+
+def validate_response_mode(mode: str, allowed=RESPONSE_MODES):
+    if mode not in allowed:
+        raise HTTPException(status_code=400, detail=f"response_mode must be one of: {', '.join(allowed)}")
+
+
+def build_generate_response(mode: str, payload: dict, image_data: bytes = None, image_path: str = None,
+                            media_type: str = "image/png"):
+    """Build the response for mode from the JSON payload and the image.
+
+    The image is given either as bytes already in memory or as the path of
+    the stored file; the file is only read when the mode needs its bytes.
+    """
+    if mode == "url":
+        return payload
+
+    if mode == "binary":
+        headers = {
+            f"X-Image-{name.replace('_', '-').title()}": str(payload[name])
+            for name in HEADER_FIELDS if payload.get(name) is not None
+        }
+        if image_data is None:
+            return FileResponse(image_path, media_type=media_type, headers=headers)
+        return Response(content=image_data, media_type=media_type, headers=headers)
+
+    if image_data is None:
+        with open(image_path, "rb") as f:
+            image_data = f.read()
+    return {**payload, "image": base64.b64encode(image_data).decode()}
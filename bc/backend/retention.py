@@ -0,0 +1,204 @@
+"""Incremental background retention for gallery images.
+
+Expired rows are removed in chunks of RETENTION_CHUNK_SIZE. Each chunk is one
+transaction that records the filenames in ``pending_unlinks`` and deletes
+the rows with a single set-based DELETE. The files are then unlinked on a
+thread pool, and each filename is cleared from ``pending_unlinks`` once its
+file is gone. A crash between the two steps only leaves filenames behind,
+and the next run unlinks them first, so retention resumes where it stopped.
+An unlink callback can return False to keep a filename queued for a later run.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+RETENTION_INTERVAL_SECONDS = int(os.getenv('RETENTION_INTERVAL_SECONDS', 3600))
+RETENTION_CHUNK_SIZE = int(os.getenv('RETENTION_CHUNK_SIZE', 500))
+RETENTION_CHUNK_PAUSE_MS = int(os.getenv('RETENTION_CHUNK_PAUSE_MS', 10))
+RETENTION_UNLINK_WORKERS = int(os.getenv('RETENTION_UNLINK_WORKERS', 4))
+
+
+class RetentionEngine:
+    """Deletes rows of table older than retention_days, plus their files.
+
+    on_deleted, if given, is called with the (id, filename) rows of each chunk.
+    """
+
+    def __init__(self, get_connection, unlink, retention_days: int, table: str = "images",
+                 on_deleted=None, chunk_size: int = RETENTION_CHUNK_SIZE,
+                 interval_seconds: int = RETENTION_INTERVAL_SECONDS):
+        self.get_connection = get_connection
+        self.unlink = unlink
+        self.retention_days = retention_days
+        self.table = table
+        self.on_deleted = on_deleted
+        self.chunk_size = max(1, chunk_size)
+        self.interval_seconds = interval_seconds
+        self._executor = ThreadPoolExecutor(max_workers=RETENTION_UNLINK_WORKERS, thread_name_prefix="retention")
+        self._run_lock = None
+        self._task = None
+        self.running = False
+        self.runs = 0
+        self.rows_deleted = 0
+        self.files_unlinked = 0
+        self.unlink_failures = 0
+        self.unlinks_deferred = 0
+        self.current_run = None
+        self.last_run = None
+
+    def init_table(self):
+        conn = self.get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS pending_unlinks (
+                filename TEXT PRIMARY KEY,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def queue_unlink(self, filename: str):
+        """Have the next run unlink filename (e.g. a file whose row was never written); blocking"""
+        conn = self.get_connection()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO pending_unlinks (filename) VALUES (?)', (filename,))
+        conn.close()
+
+    def start(self):
+        """Create the bookkeeping table and schedule runs (needs a running loop)"""
+        self.init_table()
+        self._run_lock = asyncio.Lock()
+        self._task = asyncio.ensure_future(self._schedule())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Pending unlinks finish off the event loop
+        await asyncio.to_thread(self._executor.shutdown, True)
+
+    async def run_now(self):
+        """Run retention once (waits for a run already in progress)"""
+        async with self._run_lock:
+            return await asyncio.to_thread(self.run_once)
+
+    def run_once(self):
+        """Finish pending unlinks, then delete expired rows chunk by chunk; blocking"""
+        start = time.perf_counter()
+        self.running = True
+        self.current_run = {"rows_deleted": 0, "files_unlinked": 0, "chunks": 0}
+        try:
+            self._unlink_pending()
+            while True:
+                deleted = self._delete_chunk()
+                if not deleted:
+                    break
+                self._unlink_pending()
+                self.current_run["chunks"] += 1
+                if len(deleted) < self.chunk_size:
+                    break
+                # Let generation writes in between chunks
+                time.sleep(RETENTION_CHUNK_PAUSE_MS / 1000)
+        finally:
+            elapsed = time.perf_counter() - start
+            run = dict(self.current_run, seconds=round(elapsed, 3))
+            run["rows_per_second"] = round(run["rows_deleted"] / elapsed, 1) if elapsed else 0.0
+            run["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            self.last_run = run
+            self.current_run = None
+            self.running = False
+            self.runs += 1
+        if run["rows_deleted"]:
+            print(f"🧹 Retention removed {run['rows_deleted']} images older than {self.retention_days} days "
+                  f"in {run['seconds']}s")
+        return run
+
+    def stats(self):
+        conn = self.get_connection()
+        pending = conn.execute('SELECT COUNT(*) FROM pending_unlinks').fetchone()[0]
+        conn.close()
+        return {
+            "retention_days": self.retention_days,
+            "interval_seconds": self.interval_seconds,
+            "chunk_size": self.chunk_size,
+            "running": self.running,
+            "current_run": dict(self.current_run) if self.current_run else None,
+            "last_run": self.last_run,
+            "runs": self.runs,
+            "rows_deleted": self.rows_deleted,
+            "files_unlinked": self.files_unlinked,
+            "unlink_failures": self.unlink_failures,
+            "unlinks_deferred": self.unlinks_deferred,
+            "pending_unlinks": pending
+        }
+
+    async def _schedule(self):
+        while True:
+            try:
+                await self.run_now()
+            except Exception as e:
+                print(f"❌ Retention run failed: {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+    def _delete_chunk(self):
+        """Delete the oldest chunk of expired rows; returns their filenames"""
+        conn = self.get_connection()
+        try:
+            with conn:
+                rows = conn.execute(f'''
+                    SELECT id, filename FROM {self.table}
+                    WHERE created_at < datetime('now', ?)
+                    ORDER BY created_at
+                    LIMIT ?
+                ''', (f"-{self.retention_days} days", self.chunk_size)).fetchall()
+                if not rows:
+                    return []
+                ids = [row[0] for row in rows]
+                filenames = [row[1] for row in rows]
+                conn.executemany('INSERT OR IGNORE INTO pending_unlinks (filename) VALUES (?)',
+                                 [(filename,) for filename in filenames])
+                conn.execute(f"DELETE FROM {self.table} WHERE id IN ({', '.join('?' * len(ids))})", ids)
+        finally:
+            conn.close()
+        self.rows_deleted += len(filenames)
+        self.current_run["rows_deleted"] += len(filenames)
+        if self.on_deleted is not None:
+            self.on_deleted(rows)
+        return filenames
+
+    def _unlink_pending(self):
+        conn = self.get_connection()
+        filenames = [row[0] for row in conn.execute('SELECT filename FROM pending_unlinks').fetchall()]
+        conn.close()
+        if not filenames:
+            return
+
+        done = []
+        for filename, ok in zip(filenames, self._executor.map(self._unlink_one, filenames)):
+            if ok:
+                done.append((filename,))
+            elif ok is None:
+                self.unlinks_deferred += 1
+            else:
+                self.unlink_failures += 1
+        self.files_unlinked += len(done)
+        self.current_run["files_unlinked"] += len(done)
+
+        conn = self.get_connection()
+        with conn:
+            conn.executemany('DELETE FROM pending_unlinks WHERE filename = ?', done)
+        conn.close()
+
+    def _unlink_one(self, filename):
+        """True when the file is gone, None when unlink deferred it, False on error"""
+        try:
+            if self.unlink(filename) is False:
+                return None
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            print(f"⚠️ Could not delete {filename}, will retry: {e}")
+            return False
@@ -0,0 +1,72 @@
+"""Helpers shared by the local Stable Diffusion servers."""
+import contextlib
+import os
+import torch
+from cpu_backend import CPU_BACKEND, optimize_pipeline
+from embedding_cache import EMBEDDING_CACHE_ENABLED, PromptEmbeddingCache
+
+MODEL_ID = os.getenv('MODEL_ID', "runwayml/stable-diffusion-v1-5")
+WARMUP_ON_START = os.getenv('WARMUP_ON_START', 'true').lower() == 'true'
+WARMUP_STEPS = int(os.getenv('WARMUP_STEPS', 1))
+
+# Per-process cache of prompt embeddings (each inference worker has its own)
+embedding_cache = PromptEmbeddingCache() if EMBEDDING_CACHE_ENABLED else None
+
+
+def load_pipeline(device: str = "cpu", torch_dtype=torch.float32, cpu_backend: str = CPU_BACKEND):
+    """Load the Stable Diffusion pipeline onto device.
+
+    On CPU the optimizations named in cpu_backend (see cpu_backend.py) are
+    applied after loading.
+    """
+    from diffusers import StableDiffusionPipeline
+
+    pipe = StableDiffusionPipeline.from_pretrained(
+        MODEL_ID,
+        torch_dtype=torch_dtype,
+        safety_checker=None,
+        requires_safety_checker=False
+    )
+    pipe = pipe.to(device)
+    if device == "cpu":
+        optimize_pipeline(pipe, cpu_backend)
+    return pipe
+
+
+def run_pipeline_batch(pipe, prompts, width: int, height: int, guidance_scale: float,
+                       num_inference_steps: int, seed=None, autocast_device=None):
+    """Run one batched pipeline call and return one PIL image per prompt"""
+    generator = None
+    if seed is not None:
+        # One generator per prompt keeps each image identical to a batch-of-1 run
+        generator = [torch.Generator().manual_seed(seed) for _ in prompts]
+
+    autocast = torch.autocast(autocast_device) if autocast_device else contextlib.nullcontext()
+    with autocast:
+        if embedding_cache is None:
+            text_inputs = {"prompt": list(prompts)}
+        else:
+            # Reuse cached CLIP embeddings for the prompts and the empty negative prompt
+            text_inputs = {
+                "prompt_embeds": embedding_cache.get_embeddings(pipe, prompts),
+                "negative_prompt_embeds": embedding_cache.get_embeddings(pipe, [""] * len(prompts))
+            }
+        return pipe(
+            width=width,
+            height=height,
+            guidance_scale=guidance_scale,
+            num_inference_steps=num_inference_steps,
+            generator=generator,
+            **text_inputs
+        ).images
+
+
+def warm_up_pipeline(pipe, width: int = 512, height: int = 512, autocast_device=None):
+    """Run a tiny generation so the first real request skips one-time setup"""
+    print(f"🔥 Warming up pipeline ({WARMUP_STEPS} step at {width}x{height})...")
+    run_pipeline_batch(pipe, ["warm-up"], width, height, 7.5, WARMUP_STEPS, seed=0,
+                       autocast_device=autocast_device)
+
+
+def embedding_cache_stats():
+    return embedding_cache.stats() if embedding_cache is not None else None
@@ -0,0 +1,43 @@
+"""Coalesce identical in-flight work so that only the first caller does it.
+
+Later callers with the same key wait on the first caller's result instead
+of starting their own upstream call or pipeline run.
+"""
+import asyncio
+
+
+class SingleFlight:
+    """Deduplicate concurrent async calls that share a key"""
+
+    def __init__(self):
+        self._inflight = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key, fn):
+        """Await fn() for key, or join the call already running for it"""
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.followers += 1
+            print(f"🔗 Joined in-flight generation ({key[:12]})")
+        # Shielded so a disconnecting caller does not cancel the shared work
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "followers": self.followers
+        }
+
+    def _finish(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every waiter went away
+            task.exception()
@@ -1,11 +1,15 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import torch
 from diffusers import StableDiffusionPipeline  # Changed from FluxPipeline
 from io import BytesIO
 import base64
 from PIL import Image
+from model_loader import ModelLoader
+from sd_pipeline import WARMUP_ON_START, warm_up_pipeline
+from response_modes import UNSTORED_RESPONSE_MODES, build_generate_response, validate_response_mode
 
 
 class ImageRequest(BaseModel):
@@ -14,6 +18,7 @@ class ImageRequest(BaseModel):
     width: int = 512
     guidance_scale: float = 7.5  # Changed guidance scale
     num_inference_steps: int = 50
+    response_mode: str = "base64"  # base64 or binary
 
 app = FastAPI()
 
@@ -26,19 +31,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize the model with Stable Diffusion
-try:
+pipe = None
+model_loader = ModelLoader()
+
+def load_model():
+    """Initialize the model with Stable Diffusion"""
+    global pipe
     print("Loading Stable Diffusion model...")
-    pipe = StableDiffusionPipeline.from_pretrained(
+    loaded = StableDiffusionPipeline.from_pretrained(
         "runwayml/stable-diffusion-v1-5",
         torch_dtype=torch.float16,
         safety_checker=None,
         requires_safety_checker=False
     )
-    pipe.enable_model_cpu_offload()
+    loaded.enable_model_cpu_offload()
+    pipe = loaded
     print("Model loaded successfully!")
-except Exception as e:
-    print(f"Error loading model: {e}")
+
+def warm_up_model():
+    warm_up_pipeline(pipe)
+
+@app.on_event("startup")
+async def startup_event():
+    # Load in the background instead of at import time
+    model_loader.start(load_model, warm_up_model if WARMUP_ON_START else None)
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "model_loaded": model_loader.ready, "startup": model_loader.status()}
+
+@app.get("/ready")
+def ready():
+    """Readiness probe: 200 once the model can serve requests"""
+    status_code = 200 if model_loader.ready else 503
+    return JSONResponse(model_loader.status(), status_code=status_code)
 
 @app.get("/test")
 async def test_endpoint():
@@ -50,6 +76,10 @@ async def test_endpoint():
 
 @app.post("/api/generate")
 async def generate_image(request: ImageRequest):
+    if not model_loader.ready:
+        raise HTTPException(status_code=503, detail=f"Model not ready ({model_loader.state})")
+    validate_response_mode(request.response_mode, allowed=UNSTORED_RESPONSE_MODES)
+    
     try:
         print(f"Generating image for prompt: {request.prompt}")
         
@@ -63,16 +93,12 @@ async def generate_image(request: ImageRequest):
             generator=torch.Generator().manual_seed(42)
         ).images[0]
         
-        # Convert to base64
         buffered = BytesIO()
         image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
         
-        return {
-            "status": "success",
-            "image": img_str,
-            "prompt": request.prompt
-        }
+        return build_generate_response(
+            request.response_mode, {"status": "success", "prompt": request.prompt}, image_data=buffered.getvalue()
+        )
     except Exception as e:
         print(f"Error generating image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,16 +1,31 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
-import base64
-import io
 import os
-import json
 from datetime import datetime
 from PIL import Image
 import torch
 import time
+import threading
+import asyncio
+from generation_cache import make_cache_key
+from single_flight import SingleFlight
+from batch_scheduler import BatchScheduler
+from sd_pipeline import WARMUP_ON_START, embedding_cache_stats, load_pipeline, run_pipeline_batch, warm_up_pipeline
+from cpu_backend import CPU_BACKEND
+from inference_pool import INFERENCE_WORKERS, InferencePool
+from job_queue import JobQueue, QueueFullError
+from model_loader import ModelLoader
+from response_modes import build_generate_response, validate_response_mode
+from image_serving import ImageMetadataCache, image_response
+from image_formats import encode_for_storage
+from image_derivatives import delete_derivatives, negotiated_image
+from history_store import HistoryStore
+from blob_store import BlobStore
+from io_executor import io_stats, read_executor, shutdown_io_executors, write_executor
+from progress_stream import PREVIEW_EVERY_N_STEPS, latents_to_preview, format_sse
 
 app = FastAPI()
 
@@ -28,48 +43,63 @@ IMAGES_DIR = "generated_images"
 HISTORY_FILE = "image_history.json"
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
+# Jobs are kept in the same SQLite database as the image gallery
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///./image_gallery.db')
+DATABASE_PATH = DATABASE_URL.replace('sqlite:///', '').replace('sqlite:', '')
+
 class GenerateImageRequest(BaseModel):
     prompt: str
     width: int = 512
     height: int = 512
     guidance_scale: float = 7.5
     num_inference_steps: int = 10  # Reduced for faster generation
+    response_mode: str = "base64"  # base64, url or binary
 
 pipe = None
+pipe_lock = threading.Lock()
+inference_pool = None
+model_loader = ModelLoader()
+GENERATION_SEED = 42
+generation_flight = SingleFlight()
+blob_store = BlobStore(IMAGES_DIR)
+image_metadata = ImageMetadataCache()
+history_store = HistoryStore(HISTORY_FILE)
 
-def load_image_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, 'r') as f:
-            return json.load(f)
-    return []
+def load_model():
+    global pipe, inference_pool
+    if INFERENCE_WORKERS > 0:
+        # Each worker process loads (and warms up) its own copy of the model
+        pool = InferencePool(INFERENCE_WORKERS)
+        pool.start()
+        inference_pool = pool
+        print("Inference worker pool ready!")
+        return
+    
+    print("Loading Stable Diffusion model for CPU...")
+    pipe = load_pipeline("cpu", torch.float32)
+    print("Model loaded successfully on CPU!")
 
-def save_image_history(history):
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2, default=str)
+def warm_up_model():
+    with pipe_lock:
+        warm_up_pipeline(pipe)
 
-def load_model():
-    global pipe
-    try:
-        print("Loading Stable Diffusion model for CPU...")
-        from diffusers import StableDiffusionPipeline
-        
-        pipe = StableDiffusionPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5",
-            torch_dtype=torch.float32,
-            safety_checker=None,
-            requires_safety_checker=False
-        )
-        
-        pipe = pipe.to("cpu")
-        print("Model loaded successfully on CPU!")
-        return True
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        return False
+def model_ready():
+    return model_loader.ready
 
 @app.on_event("startup")
 async def startup_event():
-    load_model()
+    # Load in the background so the server answers /health right away
+    warmup = warm_up_model if WARMUP_ON_START and INFERENCE_WORKERS == 0 else None
+    model_loader.start(load_model, warmup)
+    await job_queue.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await job_queue.stop()
+    if inference_pool is not None:
+        inference_pool.shutdown()
+    await shutdown_io_executors()
+    history_store.compact()
 
 @app.get("/")
 def read_root():
@@ -77,64 +107,137 @@ def read_root():
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "model_loaded": pipe is not None}
+    return {
+        "status": "ok",
+        "model_loaded": model_ready(),
+        "cpu_backend": CPU_BACKEND,
+        "startup": model_loader.status(),
+        "inference_pool": inference_pool.stats() if inference_pool is not None else None,
+        "batching": batch_scheduler.stats(),
+        "embedding_cache": embedding_cache_stats(),
+        "jobs": job_queue.stats(),
+        "io": io_stats()
+    }
 
-@app.post("/api/generate")
-async def generate_image(request: GenerateImageRequest):
-    if pipe is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
+@app.get("/ready")
+def ready():
+    """Readiness probe: 200 once the model can serve requests"""
+    status_code = 200 if model_ready() else 503
+    return JSONResponse(model_loader.status(), status_code=status_code)
+
+def run_batch(params, prompts):
+    if inference_pool is not None:
+        return inference_pool.run_batch(params, prompts, seed=GENERATION_SEED)
+    # The pipeline's scheduler is stateful, so runs must not overlap
+    with pipe_lock:
+        return run_pipeline_batch(pipe, prompts, seed=GENERATION_SEED, **params)
+
+# One batch in flight per worker process (or one for the in-process model)
+batch_scheduler = BatchScheduler(run_batch, max_concurrent_batches=max(1, INFERENCE_WORKERS))
+
+async def run_generation(request: GenerateImageRequest):
+    """Run the pipeline and store the result (once per in-flight request key)"""
+    print(f"Generating image for prompt: '{request.prompt}'")
+    print(f"Parameters: {request.width}x{request.height}, steps: {request.num_inference_steps}")
+    print("⏳ This will take 1-3 minutes on CPU, please wait...")
     
-    try:
-        print(f"Generating image for prompt: '{request.prompt}'")
-        print(f"Parameters: {request.width}x{request.height}, steps: {request.num_inference_steps}")
-        print("⏳ This will take 1-3 minutes on CPU, please wait...")
-        
-        start_time = time.time()
-        
-        # Generate image
-        image = pipe(
-            request.prompt,
-            width=request.width,
-            height=request.height,
-            guidance_scale=request.guidance_scale,
-            num_inference_steps=request.num_inference_steps,
-            generator=torch.manual_seed(42)
-        ).images[0]
-        
-        generation_time = time.time() - start_time
-        print(f"✅ Image generated in {generation_time:.2f} seconds")
-        
-        # Save image to file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]  # Include milliseconds
-        filename = f"image_{timestamp}.png"
-        filepath = os.path.join(IMAGES_DIR, filename)
-        
-        image.save(filepath)
-        print(f"💾 Image saved to {filepath}")
+    start_time = time.time()
+    
+    # Compatible concurrent requests share one batched pipeline call
+    image = await batch_scheduler.submit(
+        {
+            "width": request.width,
+            "height": request.height,
+            "guidance_scale": request.guidance_scale,
+            "num_inference_steps": request.num_inference_steps
+        },
+        request.prompt
+    )
+    
+    generation_time = time.time() - start_time
+    print(f"✅ Image generated in {generation_time:.2f} seconds")
+    
+    # Image encoding and the file write stay off the event loop
+    return await write_executor.run(store_generated_image, request, image)
+
+def store_generated_image(request: GenerateImageRequest, image):
+    """Save a generated image to disk and history; returns (payload, stored image) (blocking)"""
+    # Encode once, in the storage format, and reuse the bytes for the file and the response
+    stored = encode_for_storage(image)
+    
+    # Save image to file; the fixed seed makes repeats identical, and those share one file
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]  # Include milliseconds
+    with blob_store.reference_lock:
+        filename = blob_store.put(stored.data, stored.extension)
+        print(f"💾 Image saved to {blob_store.path(filename)}")
         
         # Save to history
-        history = load_image_history()
         image_record = {
             "id": timestamp,
             "filename": filename,
             "prompt": request.prompt,
             "created_at": datetime.now().isoformat(),
+            "mime_type": stored.mime_type,
+            "file_size": len(stored.data),
             "url": f"/api/images/{filename}"
         }
-        history.append(image_record)
-        save_image_history(history)
-        print(f"📝 Added to history: {len(history)} total images")
-        
-        # Convert to base64 for immediate display
-        buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        
-        return {
-            "status": "success",
-            "image": img_str,
-            "prompt": request.prompt
-        }
+        history_store.append(image_record)
+    print(f"📝 Added to history: {len(history_store)} total images")
+    
+    return {
+        "status": "success",
+        "image_id": timestamp,
+        "prompt": request.prompt,
+        "filename": filename,
+        "mime_type": stored.mime_type,
+        "url": f"/api/images/{filename}"
+    }, stored
+
+def delete_stored_image(image_id):
+    """Remove a history record, and its file once no record uses it; returns the record (blocking)"""
+    with blob_store.reference_lock:
+        record = history_store.delete(image_id)
+        # Images are deduplicated, so another record may still point at the file
+        if record and not history_store.filename_refs(record["filename"]):
+            blob_store.remove(record["filename"])
+            delete_derivatives(IMAGES_DIR, record["filename"])
+    return record
+
+def request_key(request: GenerateImageRequest):
+    return make_cache_key(
+        request.prompt,
+        width=request.width,
+        height=request.height,
+        guidance_scale=request.guidance_scale,
+        num_inference_steps=request.num_inference_steps,
+        seed=GENERATION_SEED
+    )
+
+async def run_job(params: dict):
+    """Job queue handler: generate and keep only the stored file reference"""
+    # Jobs resumed at startup wait for the model instead of failing
+    if not await model_loader.wait_ready():
+        raise Exception(f"Model failed to load: {model_loader.error}")
+    request = GenerateImageRequest(**params)
+    payload, _ = await generation_flight.do(request_key(request), lambda: run_generation(request))
+    return {
+        "prompt": payload["prompt"],
+        "filename": payload["filename"],
+        "url": payload["url"]
+    }
+
+job_queue = JobQueue(DATABASE_PATH, run_job)
+
+@app.post("/api/generate")
+async def generate_image(request: GenerateImageRequest):
+    if not model_ready():
+        raise HTTPException(status_code=503, detail=f"Model not ready ({model_loader.state})")
+    validate_response_mode(request.response_mode)
+    
+    try:
+        # Identical concurrent requests share a single pipeline run
+        payload, stored = await generation_flight.do(request_key(request), lambda: run_generation(request))
+        return build_generate_response(request.response_mode, payload, image_data=stored.data, media_type=stored.mime_type)
         
     except Exception as e:
         print(f"❌ Error generating image: {e}")
@@ -142,35 +245,118 @@ async def generate_image(request: GenerateImageRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error generating image: {str(e)}")
 
+@app.post("/api/generate/stream")
+async def generate_image_stream(request: GenerateImageRequest, preview: bool = True):
+    """Generate while streaming step progress and latent previews as SSE"""
+    if not model_ready():
+        raise HTTPException(status_code=503, detail=f"Model not ready ({model_loader.state})")
+    if pipe is None:
+        raise HTTPException(status_code=503, detail="Streaming needs the in-process model (INFERENCE_WORKERS=0)")
+    
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    
+    def emit(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+    
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        data = {"step": step + 1, "total_steps": request.num_inference_steps}
+        if preview and (step + 1) % PREVIEW_EVERY_N_STEPS == 0:
+            data["preview"] = latents_to_preview(callback_kwargs["latents"])
+        emit(("progress", data))
+        return callback_kwargs
+    
+    def run():
+        try:
+            with pipe_lock:
+                emit(("started", {"total_steps": request.num_inference_steps}))
+                return pipe(
+                    request.prompt,
+                    width=request.width,
+                    height=request.height,
+                    guidance_scale=request.guidance_scale,
+                    num_inference_steps=request.num_inference_steps,
+                    generator=torch.manual_seed(GENERATION_SEED),
+                    callback_on_step_end=on_step_end
+                ).images[0]
+        finally:
+            emit(None)
+    
+    async def stream():
+        print(f"📡 Streaming generation for prompt: '{request.prompt}'")
+        generation = asyncio.ensure_future(asyncio.to_thread(run))
+        yield format_sse("queued", {"prompt": request.prompt})
+        while (event := await events.get()) is not None:
+            yield format_sse(*event)
+        try:
+            result, _ = await write_executor.run(store_generated_image, request, await generation)
+        except Exception as e:
+            print(f"❌ Error streaming image: {e}")
+            yield format_sse("error", {"detail": str(e)})
+            return
+        yield format_sse("done", {
+            "prompt": result["prompt"],
+            "filename": result["filename"],
+            "url": result["url"]
+        })
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/api/jobs", status_code=202)
+async def submit_job(request: GenerateImageRequest):
+    """Queue a generation and return its job id immediately"""
+    # Jobs may be queued while the model is still loading
+    if model_loader.state == "failed":
+        raise HTTPException(status_code=503, detail=f"Model failed to load: {model_loader.error}")
+    try:
+        job = job_queue.submit(request.model_dump())
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    print(f"📋 Job {job['job_id'][:8]} queued at position {job['position']}")
+    return job
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Poll a job's status and queue position"""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}/image")
+async def get_job_image(job_id: str):
+    """Fetch the finished image of a job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    filepath = blob_store.path(job["result"]["filename"])
+    if not os.path.exists(filepath):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(filepath)
+
 @app.get("/api/history")
 async def get_image_history():
-    history = load_image_history()
-    return {"images": history}
+    return {"images": history_store.list()}
 
 @app.get("/api/images/{filename}")
-async def get_image(filename: str):
-    filepath = os.path.join(IMAGES_DIR, filename)
-    if os.path.exists(filepath):
-        return FileResponse(filepath)
-    raise HTTPException(status_code=404, detail="Image not found")
+async def get_image(filename: str, request: Request):
+    # Negotiated against the Accept header, see negotiated_image()
+    accept = request.headers.get("accept")
+    entry = negotiated_image(image_metadata, IMAGES_DIR, filename, accept, load=False) or await read_executor.run(
+        negotiated_image, image_metadata, IMAGES_DIR, filename, accept
+    )
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return image_response(request, entry, vary="Accept")
 
 @app.delete("/api/history/{image_id}")
 async def delete_image(image_id: str):
-    history = load_image_history()
-    image_to_delete = None
-    
-    for i, img in enumerate(history):
-        if img["id"] == image_id:
-            image_to_delete = history.pop(i)
-            break
+    image_to_delete = await write_executor.run(delete_stored_image, image_id)
     
     if image_to_delete:
-        # Delete physical file
-        filepath = os.path.join(IMAGES_DIR, image_to_delete["filename"])
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        
-        save_image_history(history)
+        image_metadata.invalidate(image_to_delete["filename"])
         return {"status": "success", "message": "Image deleted"}
     
     raise HTTPException(status_code=404, detail="Image not found")
@@ -1,17 +1,36 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
 from pydantic import BaseModel
+from typing import Optional
 import uvicorn
 import base64
 import io
 import os
-import sqlite3
-from datetime import datetime, timedelta
+import json
 from PIL import Image
-import requests
+from urllib.parse import quote
 import time
+import asyncio
 from dotenv import load_dotenv
+from image_derivatives import (
+    DERIVATIVE_SIZES, backfill_derivatives, create_derivatives_safely, delete_derivatives, get_derivative,
+    negotiated_image
+)
+from image_serving import ImageMetadataCache, image_response
+from image_formats import prepare_image
+from blob_store import BLOB_GC_GRACE_SECONDS, BlobStore, blob_refcount, init_blob_refs
+from io_executor import io_stats, read_executor, shutdown_io_executors, write_executor
+from generation_cache import GenerationCache, make_cache_key
+from single_flight import SingleFlight
+from response_modes import build_generate_response, validate_response_mode
+from sqlite_pool import SQLitePool
+from prompt_search import build_match_query, init_prompt_search
+from prompt_index import PROMPT_INDEX_SNAPSHOT_SECONDS, PromptIndex
+from gallery_stats import init_gallery_stats, read_gallery_stats, read_total_images
+from write_behind import WriteBehindWriter
+from retention import RetentionEngine
+from http_client import get_http_client, close_http_client, http_client_info
+from provider_strategy import ProviderRunner
 
 # Load environment variables
 load_dotenv()
@@ -32,6 +51,9 @@ HOST = os.getenv('HOST', '0.0.0.0')
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///./image_gallery.db')
 STABILITY_API_KEY = os.getenv('STABILITY_API_KEY')
 CLEANUP_DAYS = int(os.getenv('CLEANUP_DAYS', 30))
+GALLERY_PAGE_SIZE = int(os.getenv('GALLERY_PAGE_SIZE', 50))
+GALLERY_MAX_PAGE_SIZE = int(os.getenv('GALLERY_MAX_PAGE_SIZE', 200))
+SEARCH_MAX_OFFSET = int(os.getenv('SEARCH_MAX_OFFSET', 1000))
 
 print(f"🔧 Configuration:")
 print(f"   Database: {DATABASE_URL}")
@@ -41,20 +63,44 @@ if STABILITY_API_KEY:
     print(f"   Stability AI: {STABILITY_API_KEY[:10]}...")
 else:
     print("   Using Pollinations API (fallback)")
+print(f"   Provider strategy: {os.getenv('PROVIDER_STRATEGY', 'sequential')}")
 
 # Extract database path from URL
 DATABASE_PATH = DATABASE_URL.replace('sqlite:///', '').replace('sqlite:', '')
 IMAGES_DIR = "generated_images"
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
+# Fixed Stability AI parameters (part of the generation cache key)
+STABILITY_CFG_SCALE = 7
+STABILITY_STEPS = 30
+STABILITY_SEED = 0
+
+db_pool = SQLitePool(DATABASE_PATH)
+# Image metadata inserts are group-committed (see write_behind.py)
+image_writer = WriteBehindWriter(
+    lambda: db_pool.connection(), "images",
+    ("filename", "prompt", "created_at", "file_size", "width", "height", "mime_type")
+)
+blob_store = BlobStore(IMAGES_DIR)
+generation_cache = GenerationCache(IMAGES_DIR)
+image_metadata = ImageMetadataCache()
+generation_flight = SingleFlight()
+provider_runner = ProviderRunner()
+prompt_search_enabled = False
+prompt_index = PromptIndex()
+
 class GenerateImageRequest(BaseModel):
     prompt: str
     width: int = 512
     height: int = 512
+    use_cache: bool = True
+    response_mode: str = "base64"  # base64, url or binary
+    # Return an existing image of the same size whose prompt is at least this similar (0-1)
+    reuse_threshold: Optional[float] = None
 
 def get_db_connection():
-    """Get database connection"""
-    return sqlite3.connect(DATABASE_PATH)
+    """Get this thread's pooled database connection (close() returns it to the pool)"""
+    return db_pool.connection()
 
 def init_database():
     """Initialize SQLite database for storing image metadata"""
@@ -69,103 +115,204 @@ def init_database():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             file_size INTEGER,
             width INTEGER,
-            height INTEGER
+            height INTEGER,
+            mime_type TEXT
         )
     ''')
-    
+
+    # Galleries created before formats were detected have no mime_type column
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(images)')}
+    if "mime_type" not in columns:
+        cursor.execute('ALTER TABLE images ADD COLUMN mime_type TEXT')
+
+    # Newest-first keyset pagination and age-based cleanup both use this index
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_images_created_at
+        ON images (created_at DESC, id DESC)
+    ''')
+
     conn.commit()
+    init_gallery_stats(conn)
+    init_blob_refs(conn, "images")
+    global prompt_search_enabled
+    prompt_search_enabled = init_prompt_search(conn, "images")
     conn.close()
+    # Create pending_unlinks here too: every schema change has to happen before other
+    # threads open pooled connections, or SQLite can fail their first INSERT into images
+    # with "no such table" once the FTS and stats triggers exist
+    retention.init_table()
     print(f"✅ Database initialized: {DATABASE_PATH}")
 
-def cleanup_old_images():
-    """Remove images older than CLEANUP_DAYS"""
-    try:
-        cutoff_date = datetime.now() - timedelta(days=CLEANUP_DAYS)
-        
+def remove_image_files(filename):
+    """Delete an image and its derivatives once no row references it.
+
+    Returns False while the file is inside its grace period, so the retention
+    engine keeps it queued: a row reusing it may still be in the write buffer.
+    """
+    # Held with put_blob(): a put of the same content between the grace-period check and
+    # the unlink would otherwise hand out the name of a file about to disappear
+    with blob_store.reference_lock:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get old images
-        cursor.execute('''
-            SELECT id, filename FROM images 
-            WHERE created_at < ?
-        ''', (cutoff_date.isoformat(),))
-        
-        old_images = cursor.fetchall()
-        
-        if old_images:
-            print(f"🧹 Cleaning up {len(old_images)} images older than {CLEANUP_DAYS} days...")
-            
-            for image_id, filename in old_images:
-                # Delete physical file
-                filepath = os.path.join(IMAGES_DIR, filename)
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                    print(f"🗑️ Deleted file: {filename}")
-                
-                # Delete from database
-                cursor.execute('DELETE FROM images WHERE id = ?', (image_id,))
-            
-            conn.commit()
-            print(f"✅ Cleanup completed! Removed {len(old_images)} old images.")
-        else:
-            print(f"✅ No images older than {CLEANUP_DAYS} days found.")
-        
+        refs = blob_refcount(conn, filename)
         conn.close()
-        
-    except Exception as e:
-        print(f"❌ Cleanup error: {e}")
+        if refs:
+            return True
+        if not blob_store.remove(filename, min_age=BLOB_GC_GRACE_SECONDS):
+            return False
+    delete_derivatives(IMAGES_DIR, filename)
+    image_metadata.invalidate(filename)
+    print(f"🗑️ Deleted file: {filename}")
+    return True
+
+def put_blob(stored):
+    """Store a prepared image; returns its blob name (blocking)"""
+    with blob_store.reference_lock:
+        return blob_store.put(stored.data, stored.extension)
 
-def save_image_to_db(filename, prompt, file_size, width, height):
-    """Save image metadata to database"""
+def forget_images(rows):
+    """Drop cached and indexed references to (id, filename) rows removed by retention"""
+    for image_id, filename in rows:
+        generation_cache.invalidate_filename(filename)
+        image_metadata.invalidate(filename)
+        prompt_index.remove(image_id)
+
+def sync_prompt_index():
+    """Load the prompt index snapshot and apply rows added or deleted since it was taken"""
+    loaded = prompt_index.load()
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO images (filename, prompt, file_size, width, height)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (filename, prompt, file_size, width, height))
-    
-    conn.commit()
-    image_id = cursor.lastrowid
+    db_ids = {row[0] for row in conn.execute('SELECT id FROM images')}
+    indexed = prompt_index.ids()
+    for image_id in indexed - db_ids:
+        prompt_index.remove(image_id)
+    missing = sorted(db_ids - indexed)
+    for start in range(0, len(missing), 500):
+        chunk = missing[start:start + 500]
+        rows = conn.execute(f"SELECT id, prompt FROM images WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        for image_id, prompt in rows:
+            prompt_index.add(image_id, prompt)
     conn.close()
+    print(f"🧭 Prompt index ready: {len(prompt_index)} prompts ({loaded} from snapshot, {len(missing)} added)")
+    if prompt_index.dirty:
+        prompt_index.save()
+
+async def snapshot_prompt_index():
+    while True:
+        await asyncio.sleep(PROMPT_INDEX_SNAPSHOT_SECONDS)
+        if prompt_index.dirty:
+            await write_executor.run(prompt_index.save)
+
+def get_images_by_ids(image_ids):
+    """Gallery entries for image_ids, keyed by id"""
+    if not image_ids:
+        return {}
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT id, filename, prompt, created_at, file_size, width, height, mime_type,
+               CAST(julianday('now') - julianday(created_at) AS INTEGER) AS days_ago
+        FROM images
+        WHERE id IN ({', '.join('?' * len(image_ids))})
+    ''', list(image_ids)).fetchall()
+    conn.close()
+    return {row[0]: image_row_to_dict(row) for row in rows}
+
+def find_similar_images(prompt, k=5, min_score=0.0):
+    """Stored images with the most similar prompts, best first"""
+    matches = prompt_index.search(prompt, k, min_score)
+    images = get_images_by_ids([image_id for image_id, _ in matches])
+    return [{**images[image_id], "similarity": score} for image_id, score in matches if image_id in images]
+
+retention = RetentionEngine(lambda: db_pool.connection(), remove_image_files, CLEANUP_DAYS, on_deleted=forget_images)
+
+async def save_image_to_db(filename, prompt, file_size, width, height, mime_type):
+    """Queue image metadata for the next group commit; returns the new image id"""
+    image_id = await image_writer.insert(
+        filename=filename,
+        prompt=prompt,
+        # Same UTC format as the column's CURRENT_TIMESTAMP default
+        created_at=time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+        file_size=file_size,
+        width=width,
+        height=height,
+        mime_type=mime_type
+    )
     print(f"💾 Image saved to gallery with ID: {image_id}")
     return image_id
 
-def get_images_from_db():
-    """Get all images from database with expiration info"""
+def encode_gallery_cursor(created_at, image_id):
+    """Opaque cursor pointing just past the (created_at, id) of a gallery row"""
+    return base64.urlsafe_b64encode(json.dumps([created_at, image_id]).encode()).decode()
+
+def decode_gallery_cursor(cursor):
+    try:
+        created_at, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(created_at), int(image_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+def get_images_from_db(limit=GALLERY_PAGE_SIZE, cursor=None):
+    """Get one newest-first page of images with expiration info; returns (images, next_cursor)"""
+    after = decode_gallery_cursor(cursor) if cursor else None
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, filename, prompt, created_at, file_size, width, height
+    db_cursor = conn.cursor()
+
+    # Keyset pagination: continue strictly after the last row of the previous page.
+    # One extra row is fetched to tell whether another page exists.
+    db_cursor.execute(f'''
+        SELECT id, filename, prompt, created_at, file_size, width, height, mime_type,
+               CAST(julianday('now') - julianday(created_at) AS INTEGER) AS days_ago
         FROM images
-        ORDER BY created_at DESC
-    ''')
-    
-    images = []
-    for row in cursor.fetchall():
-        # Calculate days ago and expiration
-        created_date = datetime.fromisoformat(row[3])
-        days_ago = (datetime.now() - created_date).days
-        expires_in = CLEANUP_DAYS - days_ago
-        
-        images.append({
-            "id": str(row[0]),
-            "filename": row[1],
-            "prompt": row[2],
-            "created_at": row[3],
-            "file_size": row[4],
-            "width": row[5],
-            "height": row[6],
-            "url": f"/api/images/{row[1]}",
-            "days_ago": days_ago,
-            "expires_in_days": expires_in
-        })
-    
+        {"WHERE (created_at, id) < (?, ?)" if after else ""}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', (*(after or ()), limit + 1))
+    rows = db_cursor.fetchall()
     conn.close()
-    print(f"📸 Gallery loaded: {len(images)} images")
-    return images
+
+    next_cursor = encode_gallery_cursor(rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+    images = [image_row_to_dict(row) for row in rows[:limit]]
+
+    print(f"📸 Gallery page loaded: {len(images)} images")
+    return images, next_cursor
+
+def image_row_to_dict(row):
+    """Gallery entry for (id, filename, prompt, created_at, file_size, width, height, mime_type, days_ago)"""
+    days_ago = row[8]
+    return {
+        "id": str(row[0]),
+        "filename": row[1],
+        "prompt": row[2],
+        "created_at": row[3],
+        "file_size": row[4],
+        "width": row[5],
+        "height": row[6],
+        "mime_type": row[7],
+        "url": f"/api/images/{row[1]}",
+        "thumbnail_url": f"/api/images/{row[1]}?size=thumb",
+        "preview_url": f"/api/images/{row[1]}?size=preview",
+        "days_ago": days_ago,
+        "expires_in_days": CLEANUP_DAYS - days_ago
+    }
+
+def search_images_in_db(match_query, limit, offset):
+    """Best-ranked page of images whose prompt matches an FTS5 query"""
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT i.id, i.filename, i.prompt, i.created_at, i.file_size, i.width, i.height, i.mime_type,
+               CAST(julianday('now') - julianday(i.created_at) AS INTEGER) AS days_ago,
+               images_fts.rank
+        FROM images_fts
+        JOIN images i ON i.id = images_fts.rowid
+        WHERE images_fts MATCH ?
+        ORDER BY images_fts.rank
+        LIMIT ? OFFSET ?
+    ''', (match_query, limit + 1, offset)).fetchall()
+    conn.close()
+    
+    results = []
+    for row in rows[:limit]:
+        # bm25 rank is negative, lower is better; report a positive score
+        results.append({**image_row_to_dict(row), "score": round(-row[9], 4)})
+    return results, len(rows) > limit
 
 def delete_image_from_db(image_id):
     """Delete image from database and file system"""
@@ -178,16 +325,18 @@ def delete_image_from_db(image_id):
     
     if result:
         filename = result[0]
-        filepath = os.path.join(IMAGES_DIR, filename)
         
-        # Delete from database
-        cursor.execute('DELETE FROM images WHERE id = ?', (image_id,))
-        conn.commit()
+        # Delete from database, queueing the file like retention does
+        with conn:
+            cursor.execute('DELETE FROM images WHERE id = ?', (image_id,))
+            cursor.execute('INSERT OR IGNORE INTO pending_unlinks (filename) VALUES (?)', (filename,))
+        prompt_index.remove(image_id)
+        generation_cache.invalidate_filename(filename)
         
-        # Delete physical file
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"🗑️ Deleted file: {filepath}")
+        # Delete physical file unless another row still uses it (deduplicated)
+        if remove_image_files(filename):
+            with conn:
+                cursor.execute('DELETE FROM pending_unlinks WHERE filename = ?', (filename,))
         
         conn.close()
         print(f"🗑️ Deleted image with ID: {image_id}")
@@ -196,7 +345,7 @@ def delete_image_from_db(image_id):
     conn.close()
     return False
 
-def generate_with_stability_ai(prompt: str, width: int, height: int):
+async def generate_with_stability_ai(prompt: str, width: int, height: int):
     """Generate image using Stability AI API"""
     if not STABILITY_API_KEY:
         raise Exception("Stability AI API key not configured")
@@ -216,15 +365,16 @@ def generate_with_stability_ai(prompt: str, width: int, height: int):
                 "weight": 1
             }
         ],
-        "cfg_scale": 7,
+        "cfg_scale": STABILITY_CFG_SCALE,
         "height": height,
         "width": width,
         "samples": 1,
-        "steps": 30
+        "steps": STABILITY_STEPS,
+        "seed": STABILITY_SEED
     }
     
     print(f"🎨 Generating with Stability AI...")
-    response = requests.post(url, headers=headers, json=payload, timeout=60)
+    response = await get_http_client().post(url, headers=headers, json=payload, timeout=60)
     
     if response.status_code != 200:
         error_msg = f"Stability AI API error: {response.status_code} - {response.text}"
@@ -239,22 +389,46 @@ def generate_with_stability_ai(prompt: str, width: int, height: int):
     image_base64 = data["artifacts"][0]["base64"]
     return base64.b64decode(image_base64)
 
+async def generate_with_pollinations(prompt: str, width: int, height: int):
+    """Generate image using the free Pollinations API"""
+    api_url = f"https://image.pollinations.ai/prompt/{quote(prompt, safe='')}"
+    response = await get_http_client().get(
+        api_url, params={"width": width, "height": height}, timeout=30, follow_redirects=True
+    )
+    if response.status_code != 200:
+        raise Exception(f"Pollinations API error: {response.status_code}")
+    return response.content
+
 @app.on_event("startup")
 async def startup_event():
     init_database()
-    # Auto cleanup on startup
-    cleanup_old_images()
+    image_writer.start()
+    await asyncio.to_thread(sync_prompt_index)
+    asyncio.ensure_future(snapshot_prompt_index())
+    # Expired images are removed in the background, starting now
+    retention.start()
     
     # Test database connection
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM images')
-        count = cursor.fetchone()[0]
+        count = read_total_images(conn)
         conn.close()
         print(f"📊 Gallery ready! {count} images in database")
     except Exception as e:
         print(f"❌ Database connection failed: {e}")
+    
+    # Thumbnails for images generated before derivatives existed
+    asyncio.ensure_future(write_executor.run(backfill_derivatives, IMAGES_DIR))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_client()
+    await image_writer.stop()
+    await retention.stop()
+    await shutdown_io_executors()
+    if prompt_index.dirty:
+        prompt_index.save()
+    db_pool.close_all()
 
 @app.get("/")
 def read_root():
@@ -269,9 +443,7 @@ def read_root():
 def health():
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM images')
-        count = cursor.fetchone()[0]
+        count = read_total_images(conn)
         conn.close()
         return {
             "status": "ok", 
@@ -288,112 +460,242 @@ def health():
             "error": str(e)
         }
 
-@app.post("/api/generate")
-async def generate_image(request: GenerateImageRequest):
+def generation_cache_key(request: GenerateImageRequest):
+    # No provider in the key: whichever provider won (fallback, hedge or race) serves later
+    # identical requests, and the entry records which one produced the image
+    return make_cache_key(
+        request.prompt,
+        width=request.width,
+        height=request.height,
+        cfg_scale=STABILITY_CFG_SCALE,
+        steps=STABILITY_STEPS,
+        seed=STABILITY_SEED
+    )
+
+async def run_generation(request: GenerateImageRequest, cache_key: str, start_time: float):
+    """Generate, store and index one image (runs once per in-flight cache key)"""
+    # Stability AI first, Pollinations as fallback, combined per PROVIDER_STRATEGY
+    providers = []
+    if STABILITY_API_KEY:
+        providers.append(("stability", lambda: generate_with_stability_ai(request.prompt, request.width, request.height)))
+    providers.append(("pollinations", lambda: generate_with_pollinations(request.prompt, request.width, request.height)))
+    provider, image_data = await provider_runner.run(providers)
+    print(f"✅ Generated with {provider}")
+    
+    # Store the image by content hash, under its real format (recompressed if that is smaller);
+    # identical outputs share one file
+    stored = await write_executor.run(prepare_image, image_data)
+    filename = await write_executor.run(put_blob, stored)
+    
+    # Thumbnail and preview are produced off the request path
+    asyncio.ensure_future(write_executor.run(create_derivatives_safely, IMAGES_DIR, filename))
+    
+    # Size on disk, after recompression
+    file_size = len(stored.data)
+    
+    # Save to gallery database
     try:
-        print(f"🚀 Generating image: '{request.prompt}'")
-        start_time = time.time()
-        
-        # Try Stability AI first, fallback to Pollinations
-        if STABILITY_API_KEY:
-            try:
-                image_data = generate_with_stability_ai(request.prompt, request.width, request.height)
-                print("✅ Generated with Stability AI")
-            except Exception as stability_error:
-                print(f"⚠️ Stability AI failed: {stability_error}")
-                print("🔄 Falling back to Pollinations API...")
-                # Fallback to Pollinations
-                api_url = f"https://image.pollinations.ai/prompt/{request.prompt}?width={request.width}&height={request.height}"
-                response = requests.get(api_url, timeout=30)
-                if response.status_code == 200:
-                    image_data = response.content
-                    print("✅ Generated with Pollinations (fallback)")
-                else:
-                    raise Exception("Both Stability AI and Pollinations failed")
-        else:
-            # Use Pollinations API as primary
-            api_url = f"https://image.pollinations.ai/prompt/{request.prompt}?width={request.width}&height={request.height}"
-            response = requests.get(api_url, timeout=30)
-            
-            if response.status_code == 200:
-                image_data = response.content
-                print("✅ Generated with Pollinations API")
-            else:
-                raise Exception("Pollinations API failed")
-        
-        # Save image to file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
-        filename = f"gallery_{timestamp}.png"
-        filepath = os.path.join(IMAGES_DIR, filename)
-        
-        # Write image file
-        with open(filepath, 'wb') as f:
-            f.write(image_data)
-        
-        # Get file size
-        file_size = len(image_data)
-        
-        # Save to gallery database
-        image_id = save_image_to_db(
+        image_id = await save_image_to_db(
             filename=filename,
             prompt=request.prompt,
             file_size=file_size,
             width=request.width,
-            height=request.height
+            height=request.height,
+            mime_type=stored.mime_type
         )
+    except Exception:
+        # No row points at the file; retention removes it unless another row reuses it
+        await write_executor.run(retention.queue_unlink, filename)
+        raise
+    generation_cache.put(
+        cache_key, filename, file_size, image_id=str(image_id), mime_type=stored.mime_type, provider=provider
+    )
+    prompt_index.add(image_id, request.prompt)
+    
+    generation_time = time.time() - start_time
+    print(f"⚡ Generated and added to gallery in {generation_time:.2f} seconds!")
+    print(f"📁 Will auto-delete after {CLEANUP_DAYS} days")
+    
+    # Shared by every coalesced caller; each builds its own response mode
+    payload = {
+        "status": "success",
+        "prompt": request.prompt,
+        "image_id": str(image_id),
+        "filename": filename,
+        "mime_type": stored.mime_type,
+        "url": f"/api/images/{filename}",
+        "expires_in_days": CLEANUP_DAYS,
+        "cached": False,
+        "provider": provider
+    }
+    return payload, stored
+
+@app.post("/api/generate")
+async def generate_image(request: GenerateImageRequest):
+    validate_response_mode(request.response_mode)
+    try:
+        print(f"🚀 Generating image: '{request.prompt}'")
+        start_time = time.time()
         
-        generation_time = time.time() - start_time
-        print(f"⚡ Generated and added to gallery in {generation_time:.2f} seconds!")
-        print(f"📁 Will auto-delete after {CLEANUP_DAYS} days")
+        cache_key = generation_cache_key(request)
+        if request.use_cache:
+            cached = generation_cache.get(cache_key)
+            if cached:
+                print(f"♻️ Served from generation cache: {cached['filename']}")
+                payload = {
+                    "status": "success",
+                    "prompt": request.prompt,
+                    "image_id": cached["image_id"],
+                    "filename": cached["filename"],
+                    "mime_type": cached.get("mime_type"),
+                    "url": f"/api/images/{cached['filename']}",
+                    "expires_in_days": CLEANUP_DAYS,
+                    "cached": True,
+                    "provider": cached.get("provider")
+                }
+                # The file is only read if the response mode needs its bytes
+                return await read_executor.run(
+                    build_generate_response, request.response_mode, payload,
+                    image_path=blob_store.path(cached["filename"]), media_type=cached.get("mime_type") or "image/png"
+                )
         
-        # Convert to base64 for immediate display
-        img_base64 = base64.b64encode(image_data).decode()
+        if request.reuse_threshold is not None:
+            await image_writer.flush()
+            similar = await asyncio.to_thread(find_similar_images, request.prompt, 10, request.reuse_threshold)
+            match = next(
+                (image for image in similar if (image["width"], image["height"]) == (request.width, request.height)),
+                None
+            )
+            if match and os.path.exists(blob_store.path(match["filename"])):
+                print(f"♻️ Reused similar image ({match['similarity']}): '{match['prompt']}'")
+                payload = {
+                    "status": "success",
+                    "prompt": request.prompt,
+                    "image_id": match["id"],
+                    "filename": match["filename"],
+                    "mime_type": match["mime_type"],
+                    "url": match["url"],
+                    "expires_in_days": match["expires_in_days"],
+                    "cached": True,
+                    "reused_prompt": match["prompt"],
+                    "similarity": match["similarity"]
+                }
+                return await read_executor.run(
+                    build_generate_response, request.response_mode, payload,
+                    image_path=blob_store.path(match["filename"]), media_type=match["mime_type"] or "image/png"
+                )
         
-        return {
-            "status": "success",
-            "image": img_base64,
-            "prompt": request.prompt,
-            "image_id": str(image_id),
-            "filename": filename,
-            "expires_in_days": CLEANUP_DAYS
-        }
+        # Identical concurrent requests share a single generation
+        payload, stored = await generation_flight.do(
+            cache_key, lambda: run_generation(request, cache_key, start_time)
+        )
+        return build_generate_response(request.response_mode, payload, image_data=stored.data, media_type=stored.mime_type)
         
     except Exception as e:
         print(f"❌ Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/gallery")
-async def get_gallery():
-    """Get all images in gallery with expiration info"""
+async def get_gallery(limit: int = GALLERY_PAGE_SIZE, cursor: str = None):
+    """Get a page of gallery images with expiration info (pass next_cursor for the next page)"""
+    if not 1 <= limit <= GALLERY_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {GALLERY_MAX_PAGE_SIZE}")
+    # Read-your-writes: commit metadata still in the write-behind buffer
+    await image_writer.flush()
     try:
-        images = get_images_from_db()
+        images, next_cursor = get_images_from_db(limit, cursor)
+        # Whole-gallery total from the trigger-maintained stats row, not a COUNT(*)
+        conn = get_db_connection()
+        total_count = read_total_images(conn)
+        conn.close()
         return {
             "images": images,
-            "total_count": len(images),
+            "count": len(images),
+            "total_count": total_count,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
             "cleanup_days": CLEANUP_DAYS
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"Error fetching gallery: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch gallery")
 
 @app.get("/api/history")
-async def get_image_history():
-    """Get all images from database (alias for gallery)"""
-    return await get_gallery()
+async def get_image_history(limit: int = GALLERY_PAGE_SIZE, cursor: str = None):
+    """Get a page of images from database (alias for gallery)"""
+    return await get_gallery(limit, cursor)
+
+@app.get("/api/search")
+async def search_gallery(q: str, limit: int = GALLERY_PAGE_SIZE, offset: int = 0):
+    """Full-text prompt search, best matches first; the last word matches as a prefix"""
+    if not prompt_search_enabled:
+        raise HTTPException(status_code=503, detail="Prompt search needs SQLite with FTS5")
+    if not 1 <= limit <= GALLERY_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {GALLERY_MAX_PAGE_SIZE}")
+    if not 0 <= offset <= SEARCH_MAX_OFFSET:
+        raise HTTPException(status_code=400, detail=f"offset must be between 0 and {SEARCH_MAX_OFFSET}")
+    
+    match_query = build_match_query(q)
+    if match_query is None:
+        return {"query": q, "images": [], "count": 0, "next_offset": None, "has_more": False}
+    
+    # Read-your-writes: include images still in the write-behind buffer
+    await image_writer.flush()
+    images, has_more = search_images_in_db(match_query, limit, offset)
+    return {
+        "query": q,
+        "images": images,
+        "count": len(images),
+        "next_offset": offset + limit if has_more else None,
+        "has_more": has_more
+    }
+
+@app.get("/api/similar")
+async def similar_images(prompt: str, k: int = 5, min_score: float = 0.0):
+    """Stored images whose prompts are most similar to prompt"""
+    if not 1 <= k <= GALLERY_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {GALLERY_MAX_PAGE_SIZE}")
+    await image_writer.flush()
+    images = await asyncio.to_thread(find_similar_images, prompt, k, min_score)
+    return {"prompt": prompt, "images": images, "count": len(images)}
 
 @app.get("/api/images/{filename}")
-async def get_image(filename: str):
-    """Serve image files"""
-    filepath = os.path.join(IMAGES_DIR, filename)
-    if os.path.exists(filepath):
-        return FileResponse(filepath)
-    raise HTTPException(status_code=404, detail="Image not found")
+async def get_image(filename: str, request: Request, size: str = "full"):
+    """Serve image files (size=thumb or size=preview for compact derivatives).
+
+    Full-size images are negotiated against the Accept header: clients that
+    ask for WebP get a smaller lossless copy of PNGs, and clients that cannot
+    take the stored format get one they accept.
+    """
+    if size != "full":
+        if size not in DERIVATIVE_SIZES:
+            raise HTTPException(status_code=400, detail=f"Unknown size: {size}")
+        entry = image_metadata.get(filename, size)
+        if entry is None:
+            # Created on first request if generation-time creation has not run yet
+            path, media_type = await read_executor.run(get_derivative, IMAGES_DIR, filename, size)
+            if path is not None:
+                entry = await read_executor.run(image_metadata.load, filename, path, size, media_type)
+        if entry is not None:
+            return image_response(request, entry)
+        # Fall back to the original when no derivative can be made
+    
+    accept = request.headers.get("accept")
+    entry = negotiated_image(image_metadata, IMAGES_DIR, filename, accept, load=False) or await read_executor.run(
+        negotiated_image, image_metadata, IMAGES_DIR, filename, accept
+    )
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return image_response(request, entry, vary="Accept")
 
 @app.delete("/api/gallery/{image_id}")
 async def delete_from_gallery(image_id: str):
     """Manually delete image from gallery"""
+    await image_writer.flush()
     try:
-        success = delete_image_from_db(int(image_id))
+        success = await write_executor.run(delete_image_from_db, int(image_id))
         if success:
             return {"status": "success", "message": "Image removed from gallery"}
         else:
@@ -412,20 +714,20 @@ async def delete_image(image_id: str):
 @app.post("/api/cleanup")
 async def manual_cleanup():
     """Manually trigger cleanup of old images"""
+    await image_writer.flush()
     try:
-        cleanup_old_images()
+        run = await retention.run_now()
         
         # Get updated count
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM images')
-        remaining_count = cursor.fetchone()[0]
+        remaining_count = read_total_images(conn)
         conn.close()
         
         return {
             "status": "success",
             "message": f"Cleanup completed. {remaining_count} images remaining in gallery.",
-            "cleanup_days": CLEANUP_DAYS
+            "cleanup_days": CLEANUP_DAYS,
+            "run": run
         }
     except Exception as e:
         print(f"Manual cleanup error: {e}")
@@ -434,28 +736,30 @@ async def manual_cleanup():
 @app.get("/api/stats")
 async def get_stats():
     """Get gallery statistics"""
+    await image_writer.flush()
+    # Maintained by triggers (see gallery_stats.py), so no table scans here
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM images')
-    total_images = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT SUM(file_size) FROM images')
-    total_size = cursor.fetchone()[0] or 0
-    
-    # Count recent images (last 7 days)
-    recent_cutoff = datetime.now() - timedelta(days=7)
-    cursor.execute('SELECT COUNT(*) FROM images WHERE created_at > ?', (recent_cutoff.isoformat(),))
-    recent_images = cursor.fetchone()[0]
-    
+    stats = read_gallery_stats(conn, recent_days=7)
     conn.close()
     
     return {
-        "total_images": total_images,
-        "recent_images_7_days": recent_images,
-        "total_size_mb": round(total_size / (1024 * 1024), 2),
+        "total_images": stats["total_images"],
+        "recent_images_7_days": stats["recent_images"],
+        "total_size_mb": round(stats["total_bytes"] / (1024 * 1024), 2),
+        "daily": stats["daily"],
         "cleanup_days": CLEANUP_DAYS,
-        "database_path": DATABASE_PATH
+        "database_path": DATABASE_PATH,
+        "generation_cache": generation_cache.stats(),
+        "image_metadata": image_metadata.stats(),
+        "sqlite": db_pool.stats(),
+        "write_behind": image_writer.stats(),
+        "blob_store": blob_store.stats(),
+        "io": io_stats(),
+        "retention": retention.stats(),
+        "prompt_index": prompt_index.stats(),
+        "coalescing": generation_flight.stats(),
+        "upstream_http": http_client_info(),
+        "provider_strategy": provider_runner.stats()
     }
 
 if __name__ == "__main__":
@@ -1,17 +1,26 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
 from pydantic import BaseModel
 import uvicorn
 import base64
 import io
 import os
-import sqlite3
-from datetime import datetime
 from PIL import Image
-import requests
 import time
+import asyncio
 from dotenv import load_dotenv
+from image_derivatives import (
+    DERIVATIVE_SIZES, backfill_derivatives, create_derivatives_safely, delete_derivatives, get_derivative,
+    negotiated_image
+)
+from image_serving import ImageMetadataCache, image_response
+from image_formats import prepare_image
+from blob_store import BlobStore, blob_refcount, init_blob_refs
+from io_executor import io_stats, read_executor, shutdown_io_executors, write_executor
+from sqlite_pool import SQLitePool
+from gallery_stats import init_gallery_stats, read_gallery_stats, read_total_images
+from http_client import get_http_client, close_http_client
+from response_modes import build_generate_response, validate_response_mode
 
 # Load environment variables
 load_dotenv()
@@ -52,6 +61,9 @@ else:
 DATABASE_PATH = DATABASE_URL.replace('sqlite:///', '').replace('sqlite:', '')
 IMAGES_DIR = "generated_images"
 os.makedirs(IMAGES_DIR, exist_ok=True)
+blob_store = BlobStore(IMAGES_DIR)
+image_metadata = ImageMetadataCache()
+db_pool = SQLitePool(DATABASE_PATH)
 
 print(f"🔧 Configuration:")
 print(f"   Database: {DATABASE_PATH}")
@@ -62,10 +74,11 @@ class GenerateImageRequest(BaseModel):
     prompt: str
     width: int = 1024
     height: int = 1024
+    response_mode: str = "base64"  # base64, url or binary
 
 def get_db_connection():
-    """Get database connection"""
-    return sqlite3.connect(DATABASE_PATH)
+    """Get this thread's pooled database connection (close() returns it to the pool)"""
+    return db_pool.connection()
 
 def init_database():
     """Initialize SQLite database for storing image metadata"""
@@ -80,23 +93,31 @@ def init_database():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             file_size INTEGER,
             width INTEGER,
-            height INTEGER
+            height INTEGER,
+            mime_type TEXT
         )
     ''')
+
+    # Databases created before formats were detected have no mime_type column
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(images)')}
+    if "mime_type" not in columns:
+        cursor.execute('ALTER TABLE images ADD COLUMN mime_type TEXT')
     
     conn.commit()
+    init_gallery_stats(conn)
+    init_blob_refs(conn, "images")
     conn.close()
     print(f"✅ Database initialized: {DATABASE_PATH}")
 
-def save_image_to_db(filename, prompt, file_size, width, height):
+def save_image_to_db(filename, prompt, file_size, width, height, mime_type):
     """Save image metadata to database"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
-        INSERT INTO images (filename, prompt, file_size, width, height)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (filename, prompt, file_size, width, height))
+        INSERT INTO images (filename, prompt, file_size, width, height, mime_type)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (filename, prompt, file_size, width, height, mime_type))
     
     conn.commit()
     image_id = cursor.lastrowid
@@ -104,13 +125,28 @@ def save_image_to_db(filename, prompt, file_size, width, height):
     print(f"💾 Image saved to database with ID: {image_id}")
     return image_id
 
+def store_image(stored, prompt, width, height):
+    """Write a prepared image (see prepare_image) and its row; returns (filename, image_id) (blocking)"""
+    # Identical outputs share one file, so a concurrent delete must not unlink it in between
+    with blob_store.reference_lock:
+        filename = blob_store.put(stored.data, stored.extension)
+        image_id = save_image_to_db(
+            filename=filename,
+            prompt=prompt,
+            file_size=len(stored.data),
+            width=width,
+            height=height,
+            mime_type=stored.mime_type
+        )
+    return filename, image_id
+
 def get_images_from_db():
     """Get all images from database"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
-        SELECT id, filename, prompt, created_at, file_size, width, height
+        SELECT id, filename, prompt, created_at, file_size, width, height, mime_type
         FROM images
         ORDER BY created_at DESC
     ''')
@@ -125,7 +161,10 @@ def get_images_from_db():
             "file_size": row[4],
             "width": row[5],
             "height": row[6],
-            "url": f"/api/images/{row[1]}"
+            "mime_type": row[7],
+            "url": f"/api/images/{row[1]}",
+            "thumbnail_url": f"/api/images/{row[1]}?size=thumb",
+            "preview_url": f"/api/images/{row[1]}?size=preview"
         })
     
     conn.close()
@@ -143,16 +182,18 @@ def delete_image_from_db(image_id):
     
     if result:
         filename = result[0]
-        filepath = os.path.join(IMAGES_DIR, filename)
         
-        # Delete from database
-        cursor.execute('DELETE FROM images WHERE id = ?', (image_id,))
-        conn.commit()
-        
-        # Delete physical file
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"🗑️ Deleted file: {filepath}")
+        with blob_store.reference_lock:
+            # Delete from database
+            cursor.execute('DELETE FROM images WHERE id = ?', (image_id,))
+            conn.commit()
+            
+            # Delete physical file unless another row still uses it (deduplicated)
+            if not blob_refcount(conn, filename):
+                blob_store.remove(filename)
+                print(f"🗑️ Deleted file: {filename}")
+                delete_derivatives(IMAGES_DIR, filename)
+                image_metadata.invalidate(filename)
         
         conn.close()
         print(f"🗑️ Deleted image with ID: {image_id}")
@@ -161,7 +202,7 @@ def delete_image_from_db(image_id):
     conn.close()
     return False
 
-def generate_with_stability_ai(prompt: str, width: int, height: int):
+async def generate_with_stability_ai(prompt: str, width: int, height: int):
     """Generate image using Stability AI API"""
     if not STABILITY_API_KEY:
         raise Exception("Stability AI API key not configured")
@@ -189,7 +230,7 @@ def generate_with_stability_ai(prompt: str, width: int, height: int):
     }
     
     print(f"🔄 Calling Stability AI API...")
-    response = requests.post(url, headers=headers, json=payload, timeout=60)
+    response = await get_http_client().post(url, headers=headers, json=payload, timeout=60)
     
     if response.status_code != 200:
         error_msg = f"Stability AI API error: {response.status_code} - {response.text}"
@@ -211,13 +252,20 @@ async def startup_event():
     # Test database connection
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM images')
-        count = cursor.fetchone()[0]
+        count = read_total_images(conn)
         conn.close()
         print(f"📊 Database connected successfully! Found {count} existing images.")
     except Exception as e:
         print(f"❌ Database connection failed: {e}")
+    
+    # Thumbnails for images generated before derivatives existed
+    asyncio.ensure_future(write_executor.run(backfill_derivatives, IMAGES_DIR))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_client()
+    await shutdown_io_executors()
+    db_pool.close_all()
 
 @app.get("/")
 def read_root():
@@ -232,16 +280,15 @@ def read_root():
 def health():
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM images')
-        count = cursor.fetchone()[0]
+        count = read_total_images(conn)
         conn.close()
         return {
             "status": "ok", 
             "database": "connected",
             "database_path": DATABASE_PATH,
             "total_images": count,
-            "stability_ai": "configured" if STABILITY_API_KEY else "missing"
+            "stability_ai": "configured" if STABILITY_API_KEY else "missing",
+            "io": io_stats()
         }
     except Exception as e:
         return {
@@ -252,47 +299,36 @@ def health():
 
 @app.post("/api/generate")
 async def generate_image(request: GenerateImageRequest):
+    validate_response_mode(request.response_mode)
     try:
         print(f"🚀 Generating image with Stability AI: '{request.prompt}'")
         start_time = time.time()
         
         # Generate image using Stability AI
-        image_data = generate_with_stability_ai(request.prompt, request.width, request.height)
-        
-        # Save image to file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
-        filename = f"image_{timestamp}.png"
-        filepath = os.path.join(IMAGES_DIR, filename)
-        
-        # Write image file
-        with open(filepath, 'wb') as f:
-            f.write(image_data)
+        image_data = await generate_with_stability_ai(request.prompt, request.width, request.height)
         
-        # Get file size
-        file_size = len(image_data)
-        
-        # Save to database
-        image_id = save_image_to_db(
-            filename=filename,
-            prompt=request.prompt,
-            file_size=file_size,
-            width=request.width,
-            height=request.height
+        # Detect the real format (recompressing when smaller), store the image by content hash
+        # and save it to the database, off the event loop
+        stored = await write_executor.run(prepare_image, image_data)
+        filename, image_id = await write_executor.run(
+            store_image, stored, request.prompt, request.width, request.height
         )
         
+        # Thumbnail and preview are produced off the request path
+        asyncio.ensure_future(write_executor.run(create_derivatives_safely, IMAGES_DIR, filename))
+        
         generation_time = time.time() - start_time
         print(f"⚡ Generated and saved in {generation_time:.2f} seconds!")
         
-        # Convert to base64 for immediate display
-        img_base64 = base64.b64encode(image_data).decode()
-        
-        return {
+        payload = {
             "status": "success",
-            "image": img_base64,
             "prompt": request.prompt,
             "image_id": str(image_id),
-            "filename": filename
+            "filename": filename,
+            "mime_type": stored.mime_type,
+            "url": f"/api/images/{filename}"
         }
+        return build_generate_response(request.response_mode, payload, image_data=stored.data, media_type=stored.mime_type)
             
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -309,18 +345,37 @@ async def get_image_history():
         raise HTTPException(status_code=500, detail="Failed to fetch image history")
 
 @app.get("/api/images/{filename}")
-async def get_image(filename: str):
-    """Serve image files"""
-    filepath = os.path.join(IMAGES_DIR, filename)
-    if os.path.exists(filepath):
-        return FileResponse(filepath)
-    raise HTTPException(status_code=404, detail="Image not found")
+async def get_image(filename: str, request: Request, size: str = "full"):
+    """Serve image files (size=thumb or size=preview for compact derivatives).
+
+    Full-size images are negotiated against the Accept header, see negotiated_image().
+    """
+    if size != "full":
+        if size not in DERIVATIVE_SIZES:
+            raise HTTPException(status_code=400, detail=f"Unknown size: {size}")
+        entry = image_metadata.get(filename, size)
+        if entry is None:
+            # Created on first request if generation-time creation has not run yet
+            path, media_type = await read_executor.run(get_derivative, IMAGES_DIR, filename, size)
+            if path is not None:
+                entry = await read_executor.run(image_metadata.load, filename, path, size, media_type)
+        if entry is not None:
+            return image_response(request, entry)
+        # Fall back to the original when no derivative can be made
+    
+    accept = request.headers.get("accept")
+    entry = negotiated_image(image_metadata, IMAGES_DIR, filename, accept, load=False) or await read_executor.run(
+        negotiated_image, image_metadata, IMAGES_DIR, filename, accept
+    )
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return image_response(request, entry, vary="Accept")
 
 @app.delete("/api/history/{image_id}")
 async def delete_image(image_id: str):
     """Delete image from database and filesystem"""
     try:
-        success = delete_image_from_db(int(image_id))
+        success = await write_executor.run(delete_image_from_db, int(image_id))
         if success:
             return {"status": "success", "message": "Image deleted successfully"}
         else:
@@ -335,19 +390,12 @@ async def delete_image(image_id: str):
 async def get_stats():
     """Get gallery statistics"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM images')
-    total_images = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT SUM(file_size) FROM images')
-    total_size = cursor.fetchone()[0] or 0
-    
+    stats = read_gallery_stats(conn)
     conn.close()
     
     return {
-        "total_images": total_images,
-        "total_size_mb": round(total_size / (1024 * 1024), 2),
+        "total_images": stats["total_images"],
+        "total_size_mb": round(stats["total_bytes"] / (1024 * 1024), 2),
         "database_path": DATABASE_PATH
     }
 
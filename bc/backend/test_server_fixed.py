@@ -1,10 +1,15 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import uvicorn
 import base64
 import io
 from PIL import Image
 import torch
+from batch_scheduler import BatchScheduler
+from sd_pipeline import WARMUP_ON_START, embedding_cache_stats, load_pipeline, run_pipeline_batch, warm_up_pipeline
+from model_loader import ModelLoader
+from response_modes import UNSTORED_RESPONSE_MODES, build_generate_response, validate_response_mode
 
 # Check if CUDA is available, otherwise use CPU
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -18,42 +23,39 @@ class GenerateImageRequest(BaseModel):
     height: int = 512
     guidance_scale: float = 7.5
     num_inference_steps: int = 50
+    response_mode: str = "base64"  # base64 or binary
 
 # Global variable to store the pipeline
 pipe = None
+model_loader = ModelLoader()
 
 def load_model():
     global pipe
-    try:
-        print("Loading Stable Diffusion model...")
-        from diffusers import StableDiffusionPipeline
-        
-        # Load the pipeline
-        pipe = StableDiffusionPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5",
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-            safety_checker=None,
-            requires_safety_checker=False
-        )
-        
-        pipe = pipe.to(device)
-        
-        # Enable memory efficient attention if using CUDA
-        if device == "cuda":
-            pipe.enable_attention_slicing()
-            pipe.enable_xformers_memory_efficient_attention()
-        
-        print("Model loaded successfully!")
-        return True
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        return False
+    print("Loading Stable Diffusion model...")
+    
+    # Load the pipeline
+    loaded = load_pipeline(device, torch.float16 if device == "cuda" else torch.float32)
+    
+    # Enable memory efficient attention if using CUDA
+    if device == "cuda":
+        loaded.enable_attention_slicing()
+        loaded.enable_xformers_memory_efficient_attention()
+    
+    pipe = loaded
+    print("Model loaded successfully!")
+
+def warm_up_model():
+    warm_up_pipeline(pipe, autocast_device=device)
+
+def run_batch(params, prompts):
+    return run_pipeline_batch(pipe, prompts, autocast_device=device, **params)
+
+batch_scheduler = BatchScheduler(run_batch)
 
 @app.on_event("startup")
 async def startup_event():
-    success = load_model()
-    if not success:
-        print("Failed to load model on startup")
+    # Load in the background so the server answers /health right away
+    model_loader.start(load_model, warm_up_model if WARMUP_ON_START else None)
 
 @app.get("/")
 def read_root():
@@ -61,36 +63,46 @@ def read_root():
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "model_loaded": pipe is not None}
+    return {
+        "status": "ok",
+        "model_loaded": model_loader.ready,
+        "startup": model_loader.status(),
+        "batching": batch_scheduler.stats(),
+        "embedding_cache": embedding_cache_stats()
+    }
+
+@app.get("/ready")
+def ready():
+    """Readiness probe: 200 once the model can serve requests"""
+    status_code = 200 if model_loader.ready else 503
+    return JSONResponse(model_loader.status(), status_code=status_code)
 
 @app.post("/api/generate")
 async def generate_image(request: GenerateImageRequest):
-    if pipe is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
+    if not model_loader.ready:
+        raise HTTPException(status_code=503, detail=f"Model not ready ({model_loader.state})")
+    validate_response_mode(request.response_mode, allowed=UNSTORED_RESPONSE_MODES)
     
     try:
         print(f"Generating image for prompt: {request.prompt}")
         
-        # Generate image
-        with torch.autocast(device):
-            image = pipe(
-                request.prompt,
-                width=request.width,
-                height=request.height,
-                guidance_scale=request.guidance_scale,
-                num_inference_steps=request.num_inference_steps
-            ).images[0]
+        # Compatible concurrent requests share one batched pipeline call
+        image = await batch_scheduler.submit(
+            {
+                "width": request.width,
+                "height": request.height,
+                "guidance_scale": request.guidance_scale,
+                "num_inference_steps": request.num_inference_steps
+            },
+            request.prompt
+        )
         
-        # Convert to base64
         buffer = io.BytesIO()
         image.save(buffer, format="PNG")
-        img_str = base64.b64encode(buffer.getvalue()).decode()
         
-        return {
-            "status": "success",
-            "image": img_str,
-            "prompt": request.prompt
-        }
+        return build_generate_response(
+            request.response_mode, {"status": "success", "prompt": request.prompt}, image_data=buffer.getvalue()
+        )
         
     except Exception as e:
         print(f"Error generating image: {e}")
@@ -0,0 +1,163 @@
+"""Write-behind buffer that group-commits row inserts.
+
+Inserts are queued in memory and written by a background task in a single
+transaction per batch, flushed when WRITE_BEHIND_MAX_BATCH rows are waiting
+or WRITE_BEHIND_MAX_DELAY_MS after the first one arrived. One commit then
+covers many generated images instead of one each.
+
+``insert`` returns the row's id once the batch holding it is committed.
+SQLite assigns the ids, so other writers of the table (another server or
+worker process) cannot collide with them. A row that violates a constraint
+is rolled back on its own and only its caller gets the error.
+
+With WRITE_BEHIND_DURABLE (default) batches commit with
+``PRAGMA synchronous=FULL``, so an acknowledged row survives power loss
+even though pooled connections run WAL with synchronous=NORMAL. Otherwise
+the connection's own setting applies. Readers call ``flush()`` first to see
+rows that are still buffered (read-your-writes).
+"""
+import asyncio
+import os
+import sqlite3
+import time
+
+WRITE_BEHIND_MAX_BATCH = int(os.getenv('WRITE_BEHIND_MAX_BATCH', 64))
+WRITE_BEHIND_MAX_DELAY_MS = int(os.getenv('WRITE_BEHIND_MAX_DELAY_MS', 50))
+WRITE_BEHIND_DURABLE = os.getenv('WRITE_BEHIND_DURABLE', 'true').lower() == 'true'
+
+SYNCHRONOUS_LEVELS = {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"}
+SYNCHRONOUS_FULL = 2
+
+
+class WriteBehindWriter:
+    """Batches INSERTs into table through connections from get_connection"""
+
+    def __init__(self, get_connection, table: str, columns, max_batch_size: int = WRITE_BEHIND_MAX_BATCH,
+                 max_delay_ms: int = WRITE_BEHIND_MAX_DELAY_MS, durable: bool = WRITE_BEHIND_DURABLE):
+        self.get_connection = get_connection
+        self.table = table
+        self.columns = list(columns)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max_delay_ms / 1000
+        self.durable = durable
+        self._insert_sql = (
+            f"INSERT INTO {table} ({', '.join(self.columns)}) "
+            f"VALUES ({', '.join('?' * len(self.columns))})"
+        )
+        self._pending = []
+        self._has_pending = None
+        self._flush_lock = None
+        self._task = None
+        self.synchronous = None
+        self.batches = 0
+        self.rows_written = 0
+        self.rows_rejected = 0
+        self.failures = 0
+        self.flush_seconds = 0.0
+
+    def start(self):
+        """Start the flusher (needs a running loop)"""
+        conn = self.get_connection()
+        level = conn.execute("PRAGMA synchronous").fetchone()[0]
+        conn.close()
+        # The level batches actually commit with, see _write
+        self.synchronous = SYNCHRONOUS_LEVELS.get(max(level, SYNCHRONOUS_FULL) if self.durable else level, str(level))
+        self._has_pending = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Flush everything still buffered and stop the flusher"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def insert(self, **values) -> int:
+        """Queue one row; returns its id once it is committed"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._pending.append((tuple(values[column] for column in self.columns), waiter))
+        self._has_pending.set()
+        if len(self._pending) >= self.max_batch_size:
+            asyncio.ensure_future(self.flush())
+        return await waiter
+
+    async def flush(self):
+        """Commit every buffered row now"""
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+                start = time.perf_counter()
+                try:
+                    results = await asyncio.to_thread(self._write, [row for row, _ in batch])
+                except Exception as e:
+                    self.failures += 1
+                    print(f"❌ Write-behind flush of {len(batch)} rows failed: {e}")
+                    for _, waiter in batch:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+                self.flush_seconds += time.perf_counter() - start
+                self.batches += 1
+                for (_, waiter), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        self.rows_rejected += 1
+                        if not waiter.done():
+                            waiter.set_exception(result)
+                        continue
+                    self.rows_written += 1
+                    if not waiter.done():
+                        waiter.set_result(result)
+            self._has_pending.clear()
+
+    def stats(self):
+        return {
+            "durable": self.durable,
+            "synchronous": self.synchronous,
+            "max_batch_size": self.max_batch_size,
+            "max_delay_ms": round(self.max_delay * 1000),
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "rows_written": self.rows_written,
+            "rows_rejected": self.rows_rejected,
+            "avg_batch_size": round(self.rows_written / self.batches, 2) if self.batches else 0.0,
+            "failures": self.failures,
+            "flush_seconds": round(self.flush_seconds, 3)
+        }
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            # Give concurrent generations a short window to join this batch
+            await asyncio.sleep(self.max_delay)
+            await self.flush()
+
+    def _write(self, rows):
+        """Insert rows in one transaction; returns each row's id, or the error that rejected it"""
+        conn = self.get_connection()
+        previous = conn.execute("PRAGMA synchronous").fetchone()[0]
+        raise_sync = self.durable and previous < SYNCHRONOUS_FULL
+        if raise_sync:
+            conn.execute(f"PRAGMA synchronous={SYNCHRONOUS_FULL}")
+        results = []
+        try:
+            with conn:
+                conn.execute("BEGIN")
+                for row in rows:
+                    # A savepoint per row, so one bad row does not fail the whole batch
+                    conn.execute("SAVEPOINT write_behind_row")
+                    try:
+                        results.append(conn.execute(self._insert_sql, row).lastrowid)
+                    except sqlite3.IntegrityError as e:
+                        conn.execute("ROLLBACK TO write_behind_row")
+                        results.append(e)
+                    conn.execute("RELEASE write_behind_row")
+        finally:
+            if raise_sync:
+                conn.execute(f"PRAGMA synchronous={previous}")
+            conn.close()
+        return results